@@ -1,6 +1,7 @@
 from typing import Any
 import cv2
 import modules.globals  # Import the globals to check the color correction toggle
+from modules.utilities import detect_frame_total
 
 
 def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
@@ -26,7 +27,4 @@ def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
 
 
 def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    return detect_frame_total(video_path)
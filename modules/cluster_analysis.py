@@ -1,25 +1,62 @@
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import silhouette_score
 from typing import Any
 
+# above this many embeddings the centroids are fitted on a sample with mini batches
+CLUSTER_SAMPLE_SIZE = 10000
+CLUSTER_BATCH_SIZE = 1024
+# stop once this many k in a row failed to come close to the best inertia drop
+ELBOW_PATIENCE = 3
+
+
+def sample_embeddings(embeddings: np.ndarray, sample_size: int) -> np.ndarray:
+    # one embedding from each equal slice keeps every part of the video represented
+    strata = np.linspace(0, len(embeddings), sample_size + 1).astype(int)
+    random = np.random.default_rng(0)
+    return embeddings[[random.integers(start, end) for start, end in zip(strata[:-1], strata[1:])]]
+
 
 def find_cluster_centroids(embeddings, max_k=10) -> Any:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    # no elbow to search with fewer than two embeddings, a single one is its own centroid
+    if len(embeddings) < 2:
+        return embeddings
+    sampled = len(embeddings) > CLUSTER_SAMPLE_SIZE
+    if sampled:
+        embeddings = sample_embeddings(embeddings, CLUSTER_SAMPLE_SIZE)
     inertia = []
     cluster_centroids = []
-    K = range(1, max_k+1)
+    K = range(1, min(max_k, len(embeddings)) + 1)
 
     for k in K:
-        kmeans = KMeans(n_clusters=k, random_state=0)
+        if sampled:
+            # warm start from the previous centroids plus the embedding farthest from them
+            if cluster_centroids:
+                centroids = cluster_centroids[-1]['centroids']
+                farthest_index = np.argmin(np.max(embeddings @ centroids.T, axis=1))
+                init = np.vstack([centroids, embeddings[farthest_index]])
+            else:
+                init = embeddings.mean(axis=0, keepdims=True)
+            kmeans = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, batch_size=CLUSTER_BATCH_SIZE, random_state=0)
+        else:
+            kmeans = KMeans(n_clusters=k, random_state=0)
         kmeans.fit(embeddings)
         inertia.append(kmeans.inertia_)
         cluster_centroids.append({"k": k, "centroids": kmeans.cluster_centers_})
 
+        diffs = [inertia[i] - inertia[i+1] for i in range(len(inertia)-1)]
+        if len(diffs) > ELBOW_PATIENCE and all(diff < max(diffs) / 2 for diff in diffs[-ELBOW_PATIENCE:]):
+            break
+
     diffs = [inertia[i] - inertia[i+1] for i in range(len(inertia)-1)]
     optimal_centroids = cluster_centroids[diffs.index(max(diffs)) + 1]['centroids']
 
     return optimal_centroids
 
+def assign_clusters(embeddings, centroids) -> np.ndarray:
+    return np.argmax(np.asarray(embeddings) @ np.asarray(centroids).T, axis=1)
+
 def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
     try:
         centroids = np.array(centroids)
@@ -29,4 +66,4 @@ def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
         
         return closest_centroid_index, centroids[closest_centroid_index]
     except ValueError:
-        return None
\ No newline at end of file
+        return None
@@ -6,11 +6,16 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+from typing import Any, Dict, List
 import platform
 import signal
 import shutil
 import argparse
+import csv
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import torch
 import onnxruntime
 import tensorflow
@@ -18,8 +23,8 @@ import tensorflow
 import modules.globals
 import modules.metadata
 import modules.ui as ui
-from modules.processors.frame.core import get_frame_processors_modules
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, normalize_output_path
+from modules.processors.frame.core import get_frame_processors_modules, process_video_stream, process_video_segments, process_video_fused, get_globals_state, init_process_worker
+from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, extract_frames, get_temp_frame_paths, create_temp, clean_temp, normalize_output_path, has_checkpoint, clear_checkpoint, write_checkpoint, get_checkpoint_settings
 
 if 'ROCMExecutionProvider' in modules.globals.execution_providers:
     del torch
@@ -27,6 +32,22 @@ if 'ROCMExecutionProvider' in modules.globals.execution_providers:
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
 
+BATCH_OPTIONS = {
+    'keep_fps': bool,
+    'keep_audio': bool,
+    'many_faces': bool,
+    'mouth_mask': bool,
+    'color_correction': bool,
+    'nsfw_filter': bool,
+    'video_encoder': str,
+    'video_quality': int,
+    'temp_frame_format': str,
+    'temp_frame_compression': int,
+    'fuse_frame_processors': bool,
+    'stream_frames': bool,
+    'render_segments': int
+}
+
 
 def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
@@ -34,10 +55,26 @@ def parse_args() -> None:
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
     program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
+    program.add_argument('--batch', help='process the source target pairs of a json or csv manifest', dest='batch_path')
+    program.add_argument('--batch-jobs', help='number of batch jobs running concurrently', dest='batch_jobs', type=int, default=1)
     program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
+    program.add_argument('--fuse-frame-processors', help='run every frame processor in a single pass', dest='fuse_frame_processors', action='store_true', default=False)
+    program.add_argument('--stream-frames', help='pipe frames through ffmpeg without temporary frames', dest='stream_frames', action='store_true', default=False)
+    program.add_argument('--render-segments', help='split the video at keyframes and render segments concurrently', dest='render_segments', type=int, default=1)
+    program.add_argument('--temp-frame-format', help='image format for temporary frames', dest='temp_frame_format', default='png', choices=['png', 'bmp', 'jpg', 'npy'])
+    program.add_argument('--temp-frame-compression', help='png compression level for temporary frames', dest='temp_frame_compression', type=int, default=None, choices=range(10), metavar='[0-9]')
+    program.add_argument('--resume', help='checkpoint processed frames and resume an interrupted video', dest='resume', action='store_true', default=False)
+    program.add_argument('--detection-size', help='face detector input size', dest='detection_size', default='640', choices=['auto', '320', '480', '640', '800', '960', '1280'])
+    program.add_argument('--min-face-size', help='smallest face in pixels to detect when the detection size is auto', dest='min_face_size', type=int, default=0)
+    program.add_argument('--detection-downscale', help='longest side in pixels to downscale frames to before detection (0 to disable)', dest='detection_downscale', type=int, default=0)
+    program.add_argument('--detection-interval', help='run full face detection every n frames of the webcam or a streamed video and track faces in between', dest='detection_interval', type=int, default=1)
+    program.add_argument('--roi-detection', help='redetect faces in a window around their last known box', dest='roi_detection', action='store_true', default=False)
+    program.add_argument('--detection-batch-size', help='number of video frames to detect faces in per inference, needs a detector exported with a batch axis (the default buffalo_l detector runs one frame per inference)', dest='detection_batch_size', type=int, default=1)
+    program.add_argument('--analysis-frame-step', help='analyse every nth frame when mapping the faces of a video', dest='analysis_frame_step', type=int, default=1)
+    program.add_argument('--face-cache-dir', help='directory to cache analysed source faces in', dest='face_cache_dir')
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
     program.add_argument('--map-faces', help='map source target faces', dest='map_faces', action='store_true', default=False)
@@ -48,6 +85,11 @@ def parse_args() -> None:
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--execution-backend', help='execution backend for frame processing', dest='execution_backend', default='thread', choices=['thread', 'process'])
+    program.add_argument('--max-inflight-frames', help='maximum number of frames in flight (0 for auto)', dest='max_inflight_frames', type=int, default=0)
+    program.add_argument('--swapper-graph-optimization', help='graph optimization level of the face swapper session', dest='swapper_graph_optimization', default='all', choices=['disable', 'basic', 'extended', 'all'])
+    program.add_argument('--swapper-intra-op-threads', help='number of threads the face swapper uses within an operator (0 for auto)', dest='swapper_intra_op_threads', type=int, default=0)
+    program.add_argument('--swapper-inter-op-threads', help='number of threads the face swapper uses across operators (0 for auto)', dest='swapper_inter_op_threads', type=int, default=0)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -62,10 +104,26 @@ def parse_args() -> None:
     modules.globals.target_path = args.target_path
     modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
-    modules.globals.headless = args.source_path or args.target_path or args.output_path
+    modules.globals.batch_path = args.batch_path
+    modules.globals.batch_jobs = args.batch_jobs
+    modules.globals.headless = args.source_path or args.target_path or args.output_path or args.batch_path
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
+    modules.globals.fuse_frame_processors = args.fuse_frame_processors
+    modules.globals.stream_frames = args.stream_frames
+    modules.globals.render_segments = args.render_segments
+    modules.globals.temp_frame_format = args.temp_frame_format
+    modules.globals.temp_frame_compression = args.temp_frame_compression
+    modules.globals.resume = args.resume
+    modules.globals.detection_size = args.detection_size
+    modules.globals.min_face_size = args.min_face_size
+    modules.globals.detection_downscale = args.detection_downscale
+    modules.globals.detection_interval = args.detection_interval
+    modules.globals.roi_detection = args.roi_detection
+    modules.globals.detection_batch_size = args.detection_batch_size
+    modules.globals.face_cache_dir = args.face_cache_dir
+    modules.globals.analysis_frame_step = args.analysis_frame_step
     modules.globals.many_faces = args.many_faces
     modules.globals.nsfw_filter = args.nsfw_filter
     modules.globals.map_faces = args.map_faces
@@ -76,6 +134,11 @@ def parse_args() -> None:
     modules.globals.max_memory = args.max_memory
     modules.globals.execution_providers = decode_execution_providers(args.execution_provider)
     modules.globals.execution_threads = args.execution_threads
+    modules.globals.execution_backend = args.execution_backend
+    modules.globals.max_inflight_frames = args.max_inflight_frames
+    modules.globals.swapper_graph_optimization = args.swapper_graph_optimization
+    modules.globals.swapper_intra_op_threads = args.swapper_intra_op_threads
+    modules.globals.swapper_inter_op_threads = args.swapper_inter_op_threads
 
     #for ENHANCER tumbler:
     if 'face_enhancer' in args.frame_processor:
@@ -171,15 +234,15 @@ def update_status(message: str, scope: str = 'DLC.CORE') -> None:
     if not modules.globals.headless:
         ui.update_status(message)
 
-def start() -> None:
+def start() -> bool:
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_start():
-            return
+            return False
     update_status('Processing...')
     # process image to image
     if has_image_extension(modules.globals.target_path):
         if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
-            return
+            return False
         try:
             shutil.copy2(modules.globals.target_path, modules.globals.output_path)
         except Exception as e:
@@ -188,54 +251,175 @@ def start() -> None:
             update_status('Progressing...', frame_processor.NAME)
             frame_processor.process_image(modules.globals.source_path, modules.globals.output_path, modules.globals.output_path)
             release_resources()
-        if is_image(modules.globals.target_path):
+        done = is_image(modules.globals.output_path)
+        if done:
             update_status('Processing to image succeed!')
         else:
             update_status('Processing to image failed!')
-        return
+        return done
     # process image to videos
     if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
-        return
+        return False
 
-    if not modules.globals.map_faces:
-        update_status('Creating temp resources...')
-        create_temp(modules.globals.target_path)
-        update_status('Extracting frames...')
-        extract_frames(modules.globals.target_path)
+    if (modules.globals.stream_frames or modules.globals.render_segments > 1) and not modules.globals.map_faces:
+        fps = 30.0
+        if modules.globals.keep_fps:
+            update_status('Detecting fps...')
+            fps = detect_fps(modules.globals.target_path)
+        if modules.globals.render_segments > 1:
+            update_status(f'Rendering {modules.globals.render_segments} segments with {fps} fps...')
+            done = process_video_segments(modules.globals.source_path, modules.globals.target_path, modules.globals.output_path, fps)
+        else:
+            update_status(f'Streaming video with {fps} fps...')
+            done = process_video_stream(modules.globals.source_path, modules.globals.target_path, modules.globals.output_path, fps)
+        done = done and is_video(modules.globals.output_path)
+        if done:
+            update_status('Processing to video succeed!')
+        else:
+            update_status('Processing to video failed!')
+        return done
+    if modules.globals.stream_frames or modules.globals.render_segments > 1:
+        update_status('Streaming frames is not supported with map faces, using temp frames...')
+
+    # map faces renders the frames of its analysis unless that analysis came from the sidecar cache
+    if not modules.globals.map_faces or not get_temp_frame_paths(modules.globals.target_path):
+        if modules.globals.resume and has_checkpoint(modules.globals.target_path):
+            update_status('Resuming from checkpoint...')
+        else:
+            update_status('Creating temp resources...')
+            create_temp(modules.globals.target_path)
+            clear_checkpoint(modules.globals.target_path)
+            update_status('Extracting frames...')
+            extract_frames(modules.globals.target_path)
+            write_checkpoint(modules.globals.target_path, {'extracted': True, 'settings': get_checkpoint_settings()})
 
     temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+    if modules.globals.fuse_frame_processors:
+        update_status('Progressing fused frame processors...')
+        process_video_fused(modules.globals.source_path, temp_frame_paths)
         release_resources()
-    # handles fps
+    else:
+        for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+            update_status('Progressing...', frame_processor.NAME)
+            frame_processor.process_video(modules.globals.source_path, temp_frame_paths)
+            release_resources()
+    # handles fps and audio in a single encode
+    fps = 30.0
     if modules.globals.keep_fps:
         update_status('Detecting fps...')
         fps = detect_fps(modules.globals.target_path)
-        update_status(f'Creating video with {fps} fps...')
-        create_video(modules.globals.target_path, fps)
-    else:
-        update_status('Creating video with 30.0 fps...')
-        create_video(modules.globals.target_path)
-    # handle audio
-    if modules.globals.keep_audio:
-        if modules.globals.keep_fps:
-            update_status('Restoring audio...')
-        else:
-            update_status('Restoring audio might cause issues as fps are not kept...')
-        restore_audio(modules.globals.target_path, modules.globals.output_path)
-    else:
-        move_temp(modules.globals.target_path, modules.globals.output_path)
-    # clean and validate
-    clean_temp(modules.globals.target_path)
-    if is_video(modules.globals.target_path):
+    if modules.globals.keep_audio and not modules.globals.keep_fps:
+        update_status('Restoring audio might cause issues as fps are not kept...')
+    update_status(f'Creating video with {fps} fps...')
+    done = create_video(modules.globals.target_path, modules.globals.output_path, fps)
+    # clean and validate, a failed encode keeps the processed frames of a resumable job
+    if done or not modules.globals.resume:
+        clean_temp(modules.globals.target_path)
+    done = done and is_video(modules.globals.output_path)
+    if done:
         update_status('Processing to video succeed!')
     else:
         update_status('Processing to video failed!')
+    return done
+
+
+def parse_batch_option(name: str, value: Any) -> Any:
+    if not isinstance(value, str):
+        return value
+    if BATCH_OPTIONS[name] is bool:
+        return value.strip().lower() in ['1', 'true', 'yes']
+    return BATCH_OPTIONS[name](value)
+
+
+def load_batch_jobs(batch_path: str) -> List[Dict[str, Any]]:
+    with open(batch_path, newline='') as batch_file:
+        if batch_path.lower().endswith('.csv'):
+            rows: List[Dict[str, Any]] = list(csv.DictReader(batch_file))
+        else:
+            rows = json.load(batch_file)
+    jobs = []
+    for row in rows:
+        options = dict(row.get('options') or {})
+        options.update({name: value for name, value in row.items() if name in BATCH_OPTIONS and value not in [None, '']})
+        jobs.append({
+            'source_path': row['source'],
+            'target_path': row['target'],
+            'output_path': normalize_output_path(row['source'], row['target'], row['output']),
+            # jobs sharing a target must not share its temp frames
+            'temp_directory_name': f"{os.path.splitext(os.path.basename(row['target']))[0]}-job{len(jobs) + 1}",
+            'options': {name: parse_batch_option(name, value) for name, value in options.items() if name in BATCH_OPTIONS}
+        })
+    return jobs
+
+
+def create_batch_job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {'source': job['source_path'], 'target': job['target_path'], 'output': job['output_path'], 'status': 'failed'}
+
+
+def run_batch_job(globals_state: Dict[str, Any], job: Dict[str, Any]) -> Dict[str, Any]:
+    for name, value in globals_state.items():
+        setattr(modules.globals, name, value)
+    for name, value in job['options'].items():
+        setattr(modules.globals, name, value)
+    modules.globals.source_path = job['source_path']
+    modules.globals.target_path = job['target_path']
+    modules.globals.output_path = job['output_path']
+    modules.globals.temp_directory_name = job['temp_directory_name']
+    job_status = create_batch_job_status(job)
+    start_time = time.time()
+    try:
+        if start():
+            job_status['status'] = 'done'
+    except (Exception, SystemExit) as exception:
+        job_status['error'] = str(exception)
+    release_resources()
+    job_status['elapsed'] = round(time.time() - start_time, 2)
+    return job_status
+
+
+def run_batch() -> None:
+    batch_jobs = load_batch_jobs(modules.globals.batch_path)
+    batch_status_path = modules.globals.batch_path + '.status.json'
+    batch_status: Dict[str, Dict[str, Any]] = {}
+    if os.path.isfile(batch_status_path):
+        with open(batch_status_path) as batch_status_file:
+            batch_status = json.load(batch_status_file)
+    # jobs finished by a previous run are skipped
+    pending_jobs = [str(index) for index, job in enumerate(batch_jobs) if batch_status.get(str(index), {}).get('status') != 'done' or not os.path.isfile(job['output_path'])]
+    globals_state = get_globals_state()
+    update_status(f'Processing {len(pending_jobs)} of {len(batch_jobs)} batch jobs...')
+
+    def update_batch_status(index: str, job_status: Dict[str, Any]) -> None:
+        batch_status[index] = job_status
+        update_status(f'Batch job {int(index) + 1}/{len(batch_jobs)} {job_status["status"]}: {job_status["output"]}')
+        with open(batch_status_path + '.tmp', 'w') as batch_status_file:
+            json.dump(batch_status, batch_status_file, indent=2)
+        os.replace(batch_status_path + '.tmp', batch_status_path)
+
+    if modules.globals.batch_jobs > 1:
+        # every worker process keeps its models loaded across jobs, nested process pools are not possible
+        globals_state['execution_backend'] = 'thread'
+        with ProcessPoolExecutor(max_workers=modules.globals.batch_jobs, mp_context=multiprocessing.get_context('spawn'), initializer=init_process_worker, initargs=(globals_state,)) as executor:
+            futures = {executor.submit(run_batch_job, globals_state, batch_jobs[int(index)]): index for index in pending_jobs}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    job_status = future.result()
+                except Exception as exception:
+                    # a broken pool fails every job still pending in it
+                    job_status = create_batch_job_status(batch_jobs[int(index)])
+                    job_status['error'] = str(exception) or type(exception).__name__
+                update_batch_status(index, job_status)
+    else:
+        for index in pending_jobs:
+            update_batch_status(index, run_batch_job(globals_state, batch_jobs[int(index)]))
+    done_total = sum(job_status['status'] == 'done' for job_status in batch_status.values())
+    update_status(f'Batch finished with {done_total} of {len(batch_jobs)} jobs done.')
 
 
 def destroy(to_quit=True) -> None:
-    if modules.globals.target_path:
+    # resumable jobs keep their temp frames and checkpoint
+    if modules.globals.target_path and not modules.globals.resume:
         clean_temp(modules.globals.target_path)
     if to_quit: quit()
 
@@ -248,7 +432,9 @@ def run() -> None:
         if not frame_processor.pre_check():
             return
     limit_resources()
-    if modules.globals.headless:
+    if modules.globals.batch_path:
+        run_batch()
+    elif modules.globals.headless:
         start()
     else:
         window = ui.init(start, destroy)
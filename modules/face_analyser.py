@@ -1,43 +1,373 @@
+import json
 import os
 import shutil
-from typing import Any
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 import insightface
+from insightface.model_zoo.scrfd import distance2bbox, distance2kps
 
 import cv2
 import numpy as np
 import modules.globals
 from tqdm import tqdm
-from modules.typing import Frame
-from modules.cluster_analysis import find_cluster_centroids, find_closest_centroid
-from modules.utilities import get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths
+from modules.typing import Face, Frame
+from modules.capturer import get_video_frame
+from modules.cluster_analysis import find_cluster_centroids, assign_clusters
+from modules.utilities import get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths, read_temp_frame, get_file_hash, get_frame_number
 from pathlib import Path
 
 FACE_ANALYSER = None
+FACE_ANALYSER_MODULES = ['detection', 'recognition', 'landmark_2d_106']
+FACE_ANALYSER_KEYS = {'recognition': 'embedding', 'landmark_2d_106': 'landmark_2d_106'}
+FACE_DETECTORS: Dict[int, Any] = {}
+FACE_DETECTOR_LOCK = threading.Lock()
+DETECTION_SIZES = [320, 480, 640, 800, 960, 1280]
+# smallest face in pixels that scrfd still finds reliably at its input size
+DETECTION_MIN_FACE_SIZE = 16
+SCENE_CUT_THRESHOLD = 0.6
+TRACK_IOU_THRESHOLD = 0.3
+ROI_DETECTION_SIZE = 320
+ROI_EXPAND_FACTOR = 2.0
+# full frame detections still pick up faces entering the frame
+ROI_DETECTION_LIMIT = 10
+SOURCE_FACES: Dict[str, Any] = {}
+SOURCE_FACE_LOCK = threading.Lock()
+SOURCE_FACE_KEYS = ['bbox', 'kps', 'det_score', 'embedding', 'landmark_2d_106']
+# columns of the target video face store and the face keys they hold
+FACE_STORE_MAP_KEYS = ['face_store', 'target_faces_by_frame', 'frame_ranges']
+FACE_STORE_COLUMNS = {'bboxes': 'bbox', 'kpss': 'kps', 'landmarks': 'landmark_2d_106', 'embeddings': 'embedding', 'det_scores': 'det_score'}
 
 
 def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
     if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
+        # genderage and landmark_3d_68 are never read by the frame processors
+        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', allowed_modules=FACE_ANALYSER_MODULES, providers=modules.globals.execution_providers)
         FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
     return FACE_ANALYSER
 
 
-def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+def get_face_detector(detection_size: int) -> Any:
+    face_analyser = get_face_analyser()
+
+    with FACE_DETECTOR_LOCK:
+        if detection_size not in FACE_DETECTORS:
+            if detection_size == face_analyser.det_size[0]:
+                FACE_DETECTORS[detection_size] = face_analyser.det_model
+            else:
+                face_detector = insightface.model_zoo.get_model(face_analyser.det_model.model_file, providers=modules.globals.execution_providers)
+                face_detector.prepare(ctx_id=0, input_size=(detection_size, detection_size))
+                FACE_DETECTORS[detection_size] = face_detector
+    return FACE_DETECTORS[detection_size]
+
+
+def get_detection_size(resolution: Tuple[int, int]) -> int:
+    if modules.globals.detection_size != 'auto':
+        return int(modules.globals.detection_size)
+    max_side = max(resolution)
+    if modules.globals.min_face_size:
+        detection_size = DETECTION_MIN_FACE_SIZE * max_side / modules.globals.min_face_size
+    else:
+        detection_size = 640
+    # upscaling the frame past its own size does not reveal smaller faces
+    detection_size = min(detection_size, max_side)
+    for size in DETECTION_SIZES:
+        if size >= detection_size:
+            return size
+    return DETECTION_SIZES[-1]
+
+
+def downscale_detect_frame(frame: Frame) -> Tuple[Frame, float]:
+    max_side = max(frame.shape[:2])
+    if modules.globals.detection_downscale and max_side > modules.globals.detection_downscale:
+        detect_scale = modules.globals.detection_downscale / max_side
+        return cv2.resize(frame, None, fx=detect_scale, fy=detect_scale, interpolation=cv2.INTER_AREA), detect_scale
+    return frame, 1.0
+
+
+def create_detected_faces(bboxes: np.ndarray, kpss: Optional[np.ndarray], detect_scale: float) -> List[Face]:
+    if detect_scale != 1.0:
+        bboxes[:, 0:4] /= detect_scale
+        if kpss is not None:
+            kpss /= detect_scale
+    faces = []
+    for index in range(bboxes.shape[0]):
+        faces.append(Face(bbox=bboxes[index, 0:4], kps=kpss[index] if kpss is not None else None, det_score=bboxes[index, 4]))
+    return faces
+
+
+def detect_faces(frame: Frame) -> List[Face]:
+    detect_frame, detect_scale = downscale_detect_frame(frame)
+    face_detector = get_face_detector(get_detection_size(detect_frame.shape[:2]))
+    bboxes, kpss = face_detector.detect(detect_frame, max_num=0, metric='default')
+    return create_detected_faces(bboxes, kpss, detect_scale)
+
+
+def letterbox_detect_frame(face_detector: Any, detect_frame: Frame) -> Tuple[Frame, float]:
+    input_width, input_height = face_detector.input_size
+    frame_ratio = detect_frame.shape[0] / detect_frame.shape[1]
+    if frame_ratio > input_height / input_width:
+        resize_height = input_height
+        resize_width = int(resize_height / frame_ratio)
+    else:
+        resize_width = input_width
+        resize_height = int(resize_width * frame_ratio)
+    letterbox_frame = np.zeros((input_height, input_width, 3), dtype=np.uint8)
+    letterbox_frame[:resize_height, :resize_width] = cv2.resize(detect_frame, (resize_width, resize_height))
+    return letterbox_frame, resize_height / detect_frame.shape[0]
+
+
+def decode_detections(face_detector: Any, net_outs: List[np.ndarray], letterbox_scale: float) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    # SCRFD.forward and SCRFD.detect post processing for one image of a batched output
+    input_width, input_height = face_detector.input_size
+    scores_list = []
+    bboxes_list = []
+    kpss_list = []
+    for index, stride in enumerate(face_detector._feat_stride_fpn):
+        scores = net_outs[index]
+        center_key = (input_height // stride, input_width // stride, stride)
+        if center_key not in face_detector.center_cache:
+            anchor_centers = np.stack(np.mgrid[:center_key[0], :center_key[1]][::-1], axis=-1).astype(np.float32)
+            anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+            if face_detector._num_anchors > 1:
+                anchor_centers = np.stack([anchor_centers] * face_detector._num_anchors, axis=1).reshape((-1, 2))
+            face_detector.center_cache[center_key] = anchor_centers
+        anchor_centers = face_detector.center_cache[center_key]
+        positive_indices = np.where(scores >= face_detector.det_thresh)[0]
+        scores_list.append(scores[positive_indices])
+        bboxes_list.append(distance2bbox(anchor_centers, net_outs[index + face_detector.fmc] * stride)[positive_indices])
+        if face_detector.use_kps:
+            kpss = distance2kps(anchor_centers, net_outs[index + face_detector.fmc * 2] * stride)
+            kpss_list.append(kpss.reshape((kpss.shape[0], -1, 2))[positive_indices])
+    scores = np.vstack(scores_list)
+    order = scores.ravel().argsort()[::-1]
+    pre_det = np.hstack((np.vstack(bboxes_list) / letterbox_scale, scores)).astype(np.float32, copy=False)[order, :]
+    keep = face_detector.nms(pre_det)
+    kpss = None
+    if face_detector.use_kps:
+        kpss = (np.vstack(kpss_list) / letterbox_scale)[order][keep]
+    return pre_det[keep, :], kpss
+
+
+def detect_faces_batch(frames: List[Frame]) -> List[List[Face]]:
+    if not frames:
+        return []
+    detect_frames = [downscale_detect_frame(frame) for frame in frames]
+    face_detector = get_face_detector(get_detection_size(detect_frames[0][0].shape[:2]))
+    # detectors exported without a batch axis, like the buffalo_l one, run a frame per call
+    if len(frames) < 2 or not face_detector.batched:
+        return [create_detected_faces(*face_detector.detect(detect_frame, max_num=0, metric='default'), detect_scale) for detect_frame, detect_scale in detect_frames]
+    letterbox_frames, letterbox_scales = zip(*[letterbox_detect_frame(face_detector, detect_frame) for detect_frame, _ in detect_frames])
+    blob = cv2.dnn.blobFromImages(list(letterbox_frames), 1.0 / face_detector.input_std, face_detector.input_size, (face_detector.input_mean,) * 3, swapRB=True)
+    net_outs = face_detector.session.run(face_detector.output_names, {face_detector.input_name: blob})
+    many_faces = []
+    for index, (letterbox_scale, (_, detect_scale)) in enumerate(zip(letterbox_scales, detect_frames)):
+        bboxes, kpss = decode_detections(face_detector, [net_out[index] for net_out in net_outs], letterbox_scale)
+        many_faces.append(create_detected_faces(bboxes, kpss, detect_scale))
+    return many_faces
+
+
+def analyse_face(frame: Frame, face: Face, face_analyser_modules: List[str] = FACE_ANALYSER_MODULES) -> Face:
+    for face_analyser_module, model in get_face_analyser().models.items():
+        if face_analyser_module in face_analyser_modules and FACE_ANALYSER_KEYS.get(face_analyser_module) not in [None, *face.keys()]:
+            model.get(frame, face)
+    return face
+
+
+def create_frame_context(faces: Optional[List[Face]] = None) -> Dict[str, Any]:
+    return {'faces': faces}
+
+
+def create_frame_contexts(frames: List[Frame]) -> List[Dict[str, Any]]:
+    frame_contexts = [create_frame_context() for _ in frames]
+    if modules.globals.detection_batch_size > 1:
+        frame_indices = [index for index, frame in enumerate(frames) if frame is not None]
+        try:
+            for index, faces in zip(frame_indices, detect_faces_batch([frames[index] for index in frame_indices])):
+                frame_contexts[index]['faces'] = faces
+        except Exception as exception:
+            # a failed batch leaves every frame to detect its own faces
+            print(exception)
+            frame_contexts = [create_frame_context() for _ in frames]
+    return frame_contexts
+
+
+def get_detected_faces(frame: Frame, frame_context: Optional[Dict[str, Any]] = None) -> List[Face]:
+    if frame_context is None:
+        return detect_faces(frame)
+    if frame_context['faces'] is None:
+        frame_context['faces'] = detect_faces(frame)
+    return frame_context['faces']
+
+
+def update_frame_context(frame_context: Optional[Dict[str, Any]], swapped_faces: List[Face]) -> None:
+    # a swap keeps the face geometry but replaces its identity
+    if frame_context is not None and frame_context['faces'] is not None:
+        frame_context['faces'] = [Face({key: value for key, value in face.items() if key != 'embedding'}) if any(face is swapped_face for swapped_face in swapped_faces) else face for face in frame_context['faces']]
+
+
+def get_one_face(frame: Frame, face_analyser_modules: List[str] = FACE_ANALYSER_MODULES, frame_context: Optional[Dict[str, Any]] = None) -> Any:
+    # pick the leftmost box first so recognition and landmarks run on a single face
+    face = get_detected_faces(frame, frame_context)
     try:
-        return min(face, key=lambda x: x.bbox[0])
-    except ValueError:
+        return analyse_face(frame, min(face, key=lambda x: x.bbox[0]), face_analyser_modules)
+    except (IndexError, ValueError):
         return None
 
 
-def get_many_faces(frame: Frame) -> Any:
+def get_many_faces(frame: Frame, face_analyser_modules: List[str] = FACE_ANALYSER_MODULES, frame_context: Optional[Dict[str, Any]] = None) -> Any:
     try:
-        return get_face_analyser().get(frame)
+        return [analyse_face(frame, face, face_analyser_modules) for face in get_detected_faces(frame, frame_context)]
     except IndexError:
         return None
 
+def get_source_face_cache_path(source_hash: str) -> str:
+    return os.path.join(modules.globals.face_cache_dir, source_hash + '.npz')
+
+
+def load_source_face(source_hash: str) -> Any:
+    if modules.globals.face_cache_dir and os.path.isfile(get_source_face_cache_path(source_hash)):
+        with np.load(get_source_face_cache_path(source_hash)) as source_face:
+            return Face({key: source_face[key] for key in source_face.files})
+    return None
+
+
+def save_source_face(source_hash: str, source_face: Face) -> None:
+    if modules.globals.face_cache_dir:
+        os.makedirs(modules.globals.face_cache_dir, exist_ok=True)
+        np.savez(get_source_face_cache_path(source_hash), **{key: source_face[key] for key in SOURCE_FACE_KEYS if source_face.get(key) is not None})
+
+
+def get_source_face(source_path: str) -> Any:
+    # keyed by content so an unchanged image is never analysed twice, whatever its path
+    source_hash = get_file_hash(source_path)
+    with SOURCE_FACE_LOCK:
+        if source_hash not in SOURCE_FACES:
+            source_face = load_source_face(source_hash)
+            if source_face is None:
+                source_face = get_one_face(cv2.imread(source_path))
+                if source_face:
+                    save_source_face(source_hash, source_face)
+            SOURCE_FACES[source_hash] = source_face
+    return SOURCE_FACES[source_hash]
+
+
+def use_face_tracker() -> bool:
+    return modules.globals.detection_interval > 1 or modules.globals.roi_detection
+
+
+def create_face_tracker() -> Dict[str, Any]:
+    return {'faces': [], 'frame_number': 0, 'track_total': 0, 'roi_total': 0, 'histogram': None}
+
+
+def get_frame_histogram(frame: Frame) -> np.ndarray:
+    hsv_frame = cv2.cvtColor(cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2HSV)
+    histogram = cv2.calcHist([hsv_frame], [0, 1], None, [16, 16], [0, 180, 0, 256])
+    return cv2.normalize(histogram, histogram).flatten()
+
+
+def is_scene_cut(previous_histogram: Any, histogram: np.ndarray) -> bool:
+    return previous_histogram is not None and cv2.compareHist(previous_histogram, histogram, cv2.HISTCMP_CORREL) < SCENE_CUT_THRESHOLD
+
+
+def get_bbox_iou(bbox: np.ndarray, other_bbox: np.ndarray) -> float:
+    width = min(bbox[2], other_bbox[2]) - max(bbox[0], other_bbox[0])
+    height = min(bbox[3], other_bbox[3]) - max(bbox[1], other_bbox[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) + (other_bbox[2] - other_bbox[0]) * (other_bbox[3] - other_bbox[1]) - intersection
+    return float(intersection / union)
+
+
+def assign_track_ids(face_tracker: Dict[str, Any], faces: List[Face], previous_faces: List[Face]) -> None:
+    matched_indices = set()
+    for face in faces:
+        ious = [0.0 if index in matched_indices else get_bbox_iou(face.bbox, previous_face.bbox) for index, previous_face in enumerate(previous_faces)]
+        if ious and max(ious) >= TRACK_IOU_THRESHOLD:
+            index = int(np.argmax(ious))
+            matched_indices.add(index)
+            face.track_id = previous_faces[index].track_id
+            if previous_faces[index].embedding is not None:
+                face.embedding = previous_faces[index].embedding
+        else:
+            face.track_id = face_tracker['track_total']
+            face_tracker['track_total'] += 1
+
+
+def refine_face(frame: Frame, face: Face) -> Any:
+    refined_face = Face(bbox=face.bbox, kps=face.kps, det_score=face.det_score, track_id=face.track_id)
+    get_face_analyser().models['landmark_2d_106'].get(frame, refined_face)
+    matrix, _ = cv2.estimateAffinePartial2D(face.landmark_2d_106, refined_face.landmark_2d_106, method=cv2.LMEDS)
+    if matrix is None:
+        return None
+    scale = np.sqrt(abs(np.linalg.det(matrix[:, :2])))
+    center = matrix[:, :2] @ ((face.bbox[:2] + face.bbox[2:]) / 2) + matrix[:, 2]
+    # a collapsing or exploding box means the landmarks lost the face
+    if not 0.5 < scale < 2.0 or not (0 <= center[0] < frame.shape[1] and 0 <= center[1] < frame.shape[0]):
+        return None
+    size = (face.bbox[2:] - face.bbox[:2]) * scale / 2
+    refined_face.bbox = np.concatenate([center - size, center + size]).astype(np.float32)
+    refined_face.kps = cv2.transform(face.kps[np.newaxis].astype(np.float32), matrix)[0]
+    if face.embedding is not None:
+        refined_face.embedding = face.embedding
+    return refined_face
+
+
+def detect_faces_in_regions(frame: Frame, faces: List[Face]) -> Optional[List[Face]]:
+    face_detector = get_face_detector(ROI_DETECTION_SIZE)
+    detected_faces: List[Face] = []
+    for face in faces:
+        center = (face.bbox[:2] + face.bbox[2:]) / 2
+        half_size = max(face.bbox[2:] - face.bbox[:2]) * ROI_EXPAND_FACTOR / 2
+        left, top = np.maximum(center - half_size, 0).astype(int)
+        right, bottom = np.minimum(center + half_size, [frame.shape[1], frame.shape[0]]).astype(int)
+        if right - left < 2 or bottom - top < 2:
+            return None
+        bboxes, kpss = face_detector.detect(frame[top:bottom, left:right], max_num=0, metric='default')
+        # a region that lost its face sends the whole frame back to full detection
+        if bboxes.shape[0] == 0:
+            return None
+        bboxes[:, 0:4] += [left, top, left, top]
+        if kpss is not None:
+            kpss += [left, top]
+        for region_face in create_detected_faces(bboxes, kpss, 1.0):
+            if all(get_bbox_iou(region_face.bbox, detected_face.bbox) < 0.5 for detected_face in detected_faces):
+                detected_faces.append(region_face)
+    return detected_faces
+
+
+def track_faces(face_tracker: Dict[str, Any], frame: Frame, face_analyser_modules: List[str] = FACE_ANALYSER_MODULES) -> List[Face]:
+    # a face tracker expects the frames of one stream in order
+    histogram = get_frame_histogram(frame)
+    scene_cut = is_scene_cut(face_tracker['histogram'], histogram)
+    faces = None
+    if face_tracker['faces'] and not scene_cut and face_tracker['frame_number'] < modules.globals.detection_interval:
+        faces = [refine_face(frame, face) for face in face_tracker['faces']]
+        if any(face is None for face in faces):
+            faces = None
+    if faces is None:
+        detected_faces = None
+        if modules.globals.roi_detection and face_tracker['faces'] and not scene_cut and face_tracker['roi_total'] < ROI_DETECTION_LIMIT:
+            detected_faces = detect_faces_in_regions(frame, face_tracker['faces'])
+        if detected_faces is None:
+            detected_faces = detect_faces(frame)
+            face_tracker['roi_total'] = 0
+        else:
+            face_tracker['roi_total'] += 1
+        faces = [analyse_face(frame, face, ['landmark_2d_106']) for face in detected_faces]
+        assign_track_ids(face_tracker, faces, [] if scene_cut else face_tracker['faces'])
+        face_tracker['frame_number'] = 0
+    face_tracker['frame_number'] += 1
+    face_tracker['faces'] = faces
+    face_tracker['histogram'] = histogram
+    return [analyse_face(frame, face, face_analyser_modules) for face in faces]
+
+
 def has_valid_map() -> bool:
     for map in modules.globals.souce_target_map:
         if "source" in map and "target" in map:
@@ -97,93 +427,207 @@ def get_unique_faces_from_target_image() -> Any:
 def get_unique_faces_from_target_video() -> Any:
     try:
         modules.globals.souce_target_map = []
-        frame_face_embeddings = []
-        face_embeddings = []
-    
-        print('Creating temp resources...')
-        clean_temp(modules.globals.target_path)
-        create_temp(modules.globals.target_path)
-        print('Extracting frames...')
-        extract_frames(modules.globals.target_path)
+        face_store = load_face_store(modules.globals.target_path)
+        if face_store is None:
+            face_store = analyse_target_video(modules.globals.target_path)
+            save_face_store(modules.globals.target_path, face_store)
+        else:
+            print('Loaded face analysis from cache...')
 
-        temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        modules.globals.souce_target_map = create_face_store_maps(face_store)
 
-        i = 0
-        for temp_frame_path in tqdm(temp_frame_paths, desc="Extracting face embeddings from frames"):
-            temp_frame = cv2.imread(temp_frame_path)
-            many_faces = get_many_faces(temp_frame)
-
-            for face in many_faces:
-                face_embeddings.append(face.normed_embedding)
-            
-            frame_face_embeddings.append({'frame': i, 'faces': many_faces, 'location': temp_frame_path})
-            i += 1
-
-        centroids = find_cluster_centroids(face_embeddings)
+        # dump_faces(face_store)
+        default_target_face()
+    except ValueError:
+        return None
 
-        for frame in frame_face_embeddings:
-            for face in frame['faces']:
-                closest_centroid_index, _ = find_closest_centroid(centroids, face.normed_embedding)
-                face['target_centroid'] = closest_centroid_index
 
-        for i in range(len(centroids)):
-            modules.globals.souce_target_map.append({
-                'id' : i
-            })
+def create_face_store_maps(face_store: Dict[str, Any]) -> List[Dict[str, Any]]:
+    face_store_maps: List[Dict[str, Any]] = []
+    # group the faces by identity then frame
+    centroid_total = int(face_store['centroids'].max(initial=-1)) + 1
+    face_order = np.lexsort((face_store['frames'], face_store['centroids']))
+    centroid_bounds = np.searchsorted(face_store['centroids'][face_order], np.arange(centroid_total + 1))
+
+    for i in range(centroid_total):
+        centroid_face_indices = face_order[centroid_bounds[i]:centroid_bounds[i + 1]]
+        if not len(centroid_face_indices):
+            continue
+        frame_numbers, frame_starts = np.unique(face_store['frames'][centroid_face_indices], return_index=True)
+        face_store_maps.append({
+            'id' : len(face_store_maps),
+            'face_store' : face_store,
+            'centroid' : i,
+            'target_faces_by_frame' : dict(zip(frame_numbers.tolist(), np.split(centroid_face_indices, frame_starts[1:]))),
+            'frame_ranges' : get_frame_ranges(frame_numbers, int(face_store['analysis_frame_step']))
+        })
+    return face_store_maps
+
+
+def analyse_target_frames(temp_frame_paths: List[str]) -> Dict[str, List[Any]]:
+    face_columns: Dict[str, List[Any]] = {column: [] for column in [*FACE_STORE_COLUMNS, 'frames']}
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    for temp_frame_path, temp_frame, detected_faces in zip(temp_frame_paths, temp_frames, detect_faces_batch(temp_frames)):
+        for face in detected_faces:
+            analyse_face(temp_frame, face)
+            for column, key in FACE_STORE_COLUMNS.items():
+                face_columns[column].append(face[key])
+            face_columns['frames'].append(get_frame_number(temp_frame_path))
+    return face_columns
+
+
+def analyse_target_video(target_path: str) -> Dict[str, Any]:
+    face_columns: Dict[str, List[Any]] = {column: [] for column in [*FACE_STORE_COLUMNS, 'frames']}
+
+    print('Creating temp resources...')
+    clean_temp(target_path)
+    create_temp(target_path)
+    print('Extracting frames...')
+    extract_frames(target_path)
+
+    temp_frame_paths = get_temp_frame_paths(target_path)
+    # a sampled analysis clusters every nth frame, the others are assigned while rendering
+    analysis_frame_step = max(modules.globals.analysis_frame_step, 1)
+    analysis_frame_paths = [temp_frame_path for temp_frame_path in temp_frame_paths if is_analysis_frame(get_frame_number(temp_frame_path), analysis_frame_step)]
+    detection_batch_size = max(modules.globals.detection_batch_size, 1)
+    analysis_batches = [analysis_frame_paths[index:index + detection_batch_size] for index in range(0, len(analysis_frame_paths), detection_batch_size)]
+
+    start_time = time.time()
+    # workers decode their next frames while the others run inference, results are gathered in frame order
+    with ThreadPoolExecutor(max_workers=max(modules.globals.execution_threads or 1, 1)) as executor:
+        with tqdm(total=len(analysis_frame_paths), desc="Extracting face embeddings from frames") as progress:
+            for batch_frame_paths, batch_face_columns in zip(analysis_batches, executor.map(analyse_target_frames, analysis_batches)):
+                for column, values in batch_face_columns.items():
+                    face_columns[column].extend(values)
+                progress.update(len(batch_frame_paths))
+    if analysis_frame_step > 1 and analysis_frame_paths:
+        print(f'Analysed {len(analysis_frame_paths)} of {len(temp_frame_paths)} frames in {time.time() - start_time:.1f}s, {len(temp_frame_paths) / len(analysis_frame_paths):.1f}x fewer than a full pass.')
+
+    face_store = create_face_store(face_columns)
+    normed_embeddings = face_store['embeddings'] / np.linalg.norm(face_store['embeddings'], axis=1, keepdims=True)
+    centroids = find_cluster_centroids(normed_embeddings)
+    # every face is assigned in a single matrix product
+    face_store['centroids'] = assign_clusters(normed_embeddings, centroids).astype(np.int32)
+    face_store['centroid_vectors'] = np.asarray(centroids, dtype=np.float32)
+    face_store['analysis_frame_step'] = np.array(analysis_frame_step, dtype=np.int32)
+    return face_store
+
+
+def is_analysis_frame(frame_number: int, analysis_frame_step: int) -> bool:
+    return (frame_number - 1) % analysis_frame_step == 0
+
+
+def get_face_store_path(target_path: str) -> str:
+    return target_path + '.faces.npz'
+
+
+def get_face_store_key(target_path: str) -> str:
+    # anything that changes the detections or the frame numbering invalidates the sidecar
+    return json.dumps({
+        'hash': get_file_hash(target_path),
+        'face_analyser_modules': FACE_ANALYSER_MODULES,
+        'detection_size': modules.globals.detection_size,
+        'min_face_size': modules.globals.min_face_size,
+        'detection_downscale': modules.globals.detection_downscale,
+        'keep_fps': modules.globals.keep_fps,
+        'analysis_frame_step': max(modules.globals.analysis_frame_step, 1)
+    }, sort_keys=True)
+
+
+def load_face_store(target_path: str) -> Optional[Dict[str, Any]]:
+    face_store_path = get_face_store_path(target_path)
+    if not os.path.isfile(face_store_path):
+        return None
+    try:
+        with np.load(face_store_path) as face_store:
+            if str(face_store['key']) != get_face_store_key(target_path):
+                return None
+            return {column: face_store[column] for column in face_store.files if column != 'key'}
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # a truncated or foreign sidecar is a cache miss and gets rewritten
+        return None
 
-            temp = []
-            for frame in tqdm(frame_face_embeddings, desc=f"Mapping frame embeddings to centroids-{i}"):
-                temp.append({'frame': frame['frame'], 'faces': [face for face in frame['faces'] if face['target_centroid'] == i], 'location': frame['location']})
 
-            modules.globals.souce_target_map[i]['target_faces_in_frame'] = temp
+def save_face_store(target_path: str, face_store: Dict[str, Any]) -> None:
+    face_store_path = get_face_store_path(target_path)
+    try:
+        # write next to the sidecar and swap it in so a reader never sees a partial file
+        with open(face_store_path + '.tmp', 'wb') as face_store_file:
+            np.savez(face_store_file, key=get_face_store_key(target_path), **face_store)
+        os.replace(face_store_path + '.tmp', face_store_path)
+    except OSError:
+        print('Could not write the face analysis cache next to the target.')
+
+
+def create_face_store(face_columns: Dict[str, List[Any]]) -> Dict[str, Any]:
+    face_store = {column: np.array(values, dtype=np.float32) for column, values in face_columns.items() if column in FACE_STORE_COLUMNS}
+    face_store['frames'] = np.array(face_columns['frames'], dtype=np.int32)
+    return face_store
+
+
+def create_face_view(face_store: Dict[str, Any], face_index: int) -> Face:
+    # the arrays of a view are slices into the store, nothing is copied
+    face = Face({key: face_store[column][face_index] for column, key in FACE_STORE_COLUMNS.items()})
+    if 'centroids' in face_store:
+        face.target_centroid = int(face_store['centroids'][face_index])
+    return face
+
+
+def get_target_faces_in_frame(map: Dict[str, Any], temp_frame_path: str, temp_frame: Optional[Frame] = None, frame_context: Optional[Dict[str, Any]] = None) -> List[Face]:
+    if 'face_store' not in map:
+        return []
+    face_store = map['face_store']
+    frame_number = get_frame_number(temp_frame_path)
+    analysis_frame_step = int(face_store['analysis_frame_step'])
+    # frames skipped by a sampled analysis are assigned to the nearest identity on demand
+    if not is_analysis_frame(frame_number, analysis_frame_step) and temp_frame is not None:
+        faces = get_many_faces(temp_frame, frame_context=frame_context) or []
+        if not faces:
+            return []
+        face_centroids = assign_clusters([face.normed_embedding for face in faces], face_store['centroid_vectors'])
+        return [face for face, face_centroid in zip(faces, face_centroids) if face_centroid == map['centroid']]
+    face_indices = map['target_faces_by_frame'].get(frame_number, [])
+    return [create_face_view(face_store, face_index) for face_index in face_indices]
+
+
+def get_frame_ranges(frame_numbers: np.ndarray, frame_step: int = 1) -> List[Tuple[int, int]]:
+    if not len(frame_numbers):
+        return []
+    # a sampled analysis only stores every nth frame, so frames that far apart still belong to one range
+    range_breaks = np.flatnonzero(np.diff(frame_numbers) > frame_step)
+    range_starts = np.concatenate([frame_numbers[:1], frame_numbers[range_breaks + 1]])
+    range_ends = np.concatenate([frame_numbers[range_breaks], frame_numbers[-1:]])
+    return list(zip(range_starts.tolist(), range_ends.tolist()))
 
-        # dump_faces(centroids, frame_face_embeddings)
-        default_target_face()
-    except ValueError:
-        return None
-    
 
 def default_target_face():
     for map in modules.globals.souce_target_map:
-        best_face = None
-        best_frame = None
-        for frame in map['target_faces_in_frame']:
-            if len(frame['faces']) > 0:
-                best_face = frame['faces'][0]
-                best_frame = frame
-                break
-
-        for frame in map['target_faces_in_frame']:
-            for face in frame['faces']:
-                if face['det_score'] > best_face['det_score']:
-                    best_face = face
-                    best_frame = frame
+        face_store = map['face_store']
+        face_indices = np.concatenate(list(map['target_faces_by_frame'].values()))
+        best_face_index = face_indices[np.argmax(face_store['det_scores'][face_indices])]
+        best_face = create_face_view(face_store, best_face_index)
 
         x_min, y_min, x_max, y_max = best_face['bbox']
 
-        target_frame = cv2.imread(best_frame['location'])
+        target_frame = get_video_frame(modules.globals.target_path, int(face_store['frames'][best_face_index]))
         map['target'] = {
                         'cv2' : target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
                         'face' : best_face
                         }
 
 
-def dump_faces(centroids: Any, frame_face_embeddings: list):
+def dump_faces(face_store: Dict[str, Any]):
     temp_directory_path = get_temp_directory_path(modules.globals.target_path)
 
-    for i in range(len(centroids)):
+    for i in np.unique(face_store['centroids']):
         if os.path.exists(temp_directory_path + f"/{i}") and os.path.isdir(temp_directory_path + f"/{i}"):
             shutil.rmtree(temp_directory_path + f"/{i}")
         Path(temp_directory_path + f"/{i}").mkdir(parents=True, exist_ok=True)
 
-        for frame in tqdm(frame_face_embeddings, desc=f"Copying faces to temp/./{i}"):
-            temp_frame = cv2.imread(frame['location'])
-
-            j = 0
-            for face in frame['faces']:
-                if face['target_centroid'] == i:
-                    x_min, y_min, x_max, y_max = face['bbox']
+        for face_index in tqdm(np.flatnonzero(face_store['centroids'] == i), desc=f"Copying faces to temp/./{i}"):
+            frame_number = int(face_store['frames'][face_index])
+            temp_frame = get_video_frame(modules.globals.target_path, frame_number)
+            x_min, y_min, x_max, y_max = face_store['bboxes'][face_index]
 
-                    if temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)].size > 0:
-                        cv2.imwrite(temp_directory_path + f"/{i}/{frame['frame']}_{j}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
-                j += 1
\ No newline at end of file
+            if temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)].size > 0:
+                cv2.imwrite(temp_directory_path + f"/{i}/{frame_number}_{face_index}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
@@ -15,10 +15,27 @@ simple_map = {}
 source_path = None
 target_path = None
 output_path = None
+batch_path = None
+batch_jobs = 1
+temp_directory_name = None
 frame_processors: List[str] = []
 keep_fps = True
 keep_audio = True
 keep_frames = False
+temp_frame_format = "png"
+temp_frame_compression = None
+resume = False
+fuse_frame_processors = False
+stream_frames = False
+render_segments = 1
+detection_size = "640"
+min_face_size = 0
+detection_downscale = 0
+detection_interval = 1
+detection_batch_size = 1
+roi_detection = False
+face_cache_dir = None
+analysis_frame_step = 1
 many_faces = False
 map_faces = False
 color_correction = False  # New global variable for color correction toggle
@@ -30,6 +47,11 @@ live_resizable = False
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = None
+execution_backend = "thread"
+max_inflight_frames = 0
+swapper_graph_optimization = "all"
+swapper_intra_op_threads = 0
+swapper_inter_op_threads = 0
 headless = None
 log_level = "error"
 fp_ui: Dict[str, bool] = {"face_enhancer": False}
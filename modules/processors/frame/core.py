@@ -1,14 +1,26 @@
+import os
 import sys
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Dict, Iterable, Iterator, List, Callable, Optional, Tuple
+import numpy
 from tqdm import tqdm
 
 import modules
 import modules.globals                   
+from modules.capturer import get_video_frame_total
+from modules.face_analyser import get_source_face as get_cached_source_face, create_face_store_maps, FACE_STORE_MAP_KEYS, create_frame_context, create_frame_contexts, create_face_tracker, use_face_tracker, track_faces
+from modules.typing import Face, Frame
+from modules.utilities import detect_resolution, detect_keyframes, split_segments, open_frame_reader, open_frame_writer, read_frames, write_frame, close_frame_reader, close_frame_writer, concat_segments, create_temp, clean_temp, get_temp_directory_path, load_checkpoint, write_checkpoint, get_checkpoint_settings, get_pending_frame_paths, get_staged_frame_path, stage_temp_frame, commit_temp_frame, sync_path, read_temp_frame, write_temp_frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+SHARED_MEMORIES: Dict[str, shared_memory.SharedMemory] = {}
+SETTING_TYPES = (type(None), bool, int, float, str)
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
@@ -55,19 +67,356 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
             except:
                 pass
 
-def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], progress)
-            futures.append(future)
-        for future in futures:
-            future.result()
+def process_frame_chain(frame_processors: List[ModuleType], source_face: Optional[Face], temp_frame: Frame, temp_frame_path: str = '', frame_context: Optional[Dict[str, Any]] = None) -> Frame:
+    # every frame processor reuses the faces analysed by the previous ones
+    if frame_context is None:
+        frame_context = create_frame_context()
+    for frame_processor in frame_processors:
+        try:
+            if modules.globals.map_faces:
+                temp_frame = frame_processor.process_frame_v2(temp_frame, temp_frame_path, frame_context=frame_context)
+            else:
+                temp_frame = frame_processor.process_frame(source_face, temp_frame, frame_context=frame_context)
+        except Exception as exception:
+            print(exception)
+    return temp_frame
 
 
-def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+def get_max_inflight_frames() -> int:
+    if modules.globals.max_inflight_frames:
+        return max(modules.globals.max_inflight_frames, 1)
+    return max(modules.globals.execution_threads or 1, 1) * 4
+
+
+def run_frame_pipeline(frames: Iterable[Any], process_frame: Callable[[Any], Any], write_frame: Callable[[Any], None], execution_threads: Optional[int] = None) -> None:
+    execution_threads = max(execution_threads or modules.globals.execution_threads or 1, 1)
+    max_inflight_frames = max(get_max_inflight_frames(), execution_threads)
+    inflight_frames = threading.BoundedSemaphore(max_inflight_frames)
+    decode_queue: queue.Queue[Any] = queue.Queue(max_inflight_frames)
+    write_queue: queue.Queue[Any] = queue.Queue()
+    stop_event = threading.Event()
+    exceptions: List[BaseException] = []
+
+    def decode_frames() -> None:
+        try:
+            for index, frame in enumerate(frames):
+                inflight_frames.acquire()
+                if stop_event.is_set():
+                    break
+                decode_queue.put((index, frame))
+        except BaseException as exception:
+            exceptions.append(exception)
+            stop_event.set()
+        for _ in range(execution_threads):
+            decode_queue.put(None)
+
+    def process_frames() -> None:
+        while True:
+            item = decode_queue.get()
+            if item is None:
+                break
+            index, frame = item
+            result = None
+            if not stop_event.is_set():
+                try:
+                    result = process_frame(frame)
+                except BaseException as exception:
+                    exceptions.append(exception)
+                    stop_event.set()
+            write_queue.put((index, result))
+        write_queue.put(None)
+
+    threads = [threading.Thread(target=decode_frames, daemon=True)]
+    threads.extend(threading.Thread(target=process_frames, daemon=True) for _ in range(execution_threads))
+    for thread in threads:
+        thread.start()
+    # reorder buffer that emits frames in decode order, every buffered frame holds an inflight slot
+    reorder_buffer: Dict[int, Any] = {}
+    next_index = 0
+    finished_threads = 0
+    while finished_threads < execution_threads:
+        item = write_queue.get()
+        if item is None:
+            finished_threads += 1
+            continue
+        index, result = item
+        reorder_buffer[index] = result
+        while not stop_event.is_set() and next_index in reorder_buffer:
+            try:
+                write_frame(reorder_buffer.pop(next_index))
+            except BaseException as exception:
+                exceptions.append(exception)
+                stop_event.set()
+            next_index += 1
+            inflight_frames.release()
+        if stop_event.is_set():
+            for _ in reorder_buffer:
+                inflight_frames.release()
+            reorder_buffer.clear()
+    for thread in threads:
+        thread.join()
+    if exceptions:
+        raise exceptions[0]
+
+
+def get_source_face(source_path: str) -> Optional[Face]:
+    if modules.globals.map_faces:
+        return None
+    return get_cached_source_face(source_path)
+
+
+def is_setting(value: Any) -> bool:
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(item, SETTING_TYPES) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(item, SETTING_TYPES) for item in value.values())
+    return isinstance(value, SETTING_TYPES)
+
+
+def get_globals_state() -> Dict[str, Any]:
+    # only the plain settings are sent, the face maps go through share_face_maps
+    return {name: value for name, value in vars(modules.globals).items() if not name.startswith('_') and is_setting(value)}
+
+
+def share_face_maps() -> Tuple[List[Dict[str, Any]], Dict[str, Tuple[str, Tuple[int, ...], str]], List[shared_memory.SharedMemory]]:
+    face_maps = []
+    face_store_state: Dict[str, Tuple[str, Tuple[int, ...], str]] = {}
+    face_store_memories: List[shared_memory.SharedMemory] = []
+    for map in modules.globals.souce_target_map:
+        if 'face_store' in map and not face_store_state:
+            # the face store is copied into shared memory once instead of being pickled for every worker
+            for column, values in map['face_store'].items():
+                face_store_memory = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                numpy.ndarray(values.shape, dtype=values.dtype, buffer=face_store_memory.buf)[...] = values
+                face_store_state[column] = (face_store_memory.name, values.shape, values.dtype.str)
+                face_store_memories.append(face_store_memory)
+        face_map = {key: value for key, value in map.items() if key not in FACE_STORE_MAP_KEYS}
+        for side in ['source', 'target']:
+            if side in face_map:
+                face_map[side] = {'face': face_map[side]['face']}
+        face_maps.append(face_map)
+    return face_maps, face_store_state, face_store_memories
+
+
+def load_shared_face_maps(face_maps: List[Dict[str, Any]], face_store_state: Dict[str, Tuple[str, Tuple[int, ...], str]]) -> List[Dict[str, Any]]:
+    face_store = {}
+    for column, (shared_memory_name, shape, dtype) in face_store_state.items():
+        SHARED_MEMORIES[shared_memory_name] = shared_memory.SharedMemory(name=shared_memory_name)
+        face_store[column] = numpy.ndarray(shape, dtype=dtype, buffer=SHARED_MEMORIES[shared_memory_name].buf)
+    face_store_maps = {map['centroid']: map for map in create_face_store_maps(face_store)} if face_store else {}
+    for map in face_maps:
+        if map.get('centroid') in face_store_maps:
+            map.update({key: face_store_maps[map['centroid']][key] for key in FACE_STORE_MAP_KEYS})
+    return face_maps
+
+
+def init_process_worker(globals_state: Dict[str, Any], face_maps: Optional[List[Dict[str, Any]]] = None, face_store_state: Optional[Dict[str, Tuple[str, Tuple[int, ...], str]]] = None) -> None:
+    for name, value in globals_state.items():
+        setattr(modules.globals, name, value)
+    if face_maps is not None:
+        modules.globals.souce_target_map = load_shared_face_maps(face_maps, face_store_state or {})
+    get_frame_processors_modules(modules.globals.frame_processors)
+
+
+def create_process_pool(execution_threads: Optional[int] = None, face_maps: Optional[List[Dict[str, Any]]] = None, face_store_state: Optional[Dict[str, Tuple[str, Tuple[int, ...], str]]] = None) -> ProcessPoolExecutor:
+    # every worker process loads its own analyser and models once
+    return ProcessPoolExecutor(max_workers=max(execution_threads or modules.globals.execution_threads or 1, 1), mp_context=multiprocessing.get_context('spawn'), initializer=init_process_worker, initargs=(get_globals_state(), face_maps, face_store_state))
+
+
+def process_shared_frame(shared_memory_name: str, shape: Tuple[int, ...], source_path: str, faces: Optional[List[Face]] = None) -> Optional[Frame]:
+    if shared_memory_name not in SHARED_MEMORIES:
+        SHARED_MEMORIES[shared_memory_name] = shared_memory.SharedMemory(name=shared_memory_name)
+    temp_frame = numpy.ndarray(shape, dtype=numpy.uint8, buffer=SHARED_MEMORIES[shared_memory_name].buf)
+    result = process_frame_chain(get_frame_processors_modules(modules.globals.frame_processors), get_source_face(source_path), temp_frame, frame_context=create_frame_context(faces))
+    if result.shape != temp_frame.shape:
+        return result
+    if result is not temp_frame:
+        temp_frame[:] = result
+    return None
+
+
+def run_frame_pipeline_in_pool(frames: Iterable[Tuple[Frame, Dict[str, Any]]], source_path: str, write_frame: Callable[[Frame], None], execution_threads: Optional[int] = None) -> None:
+    shared_memories: Dict[int, shared_memory.SharedMemory] = {}
+
+    with create_process_pool(execution_threads) as process_pool:
+
+        def process_frame(item: Tuple[Frame, Dict[str, Any]]) -> Frame:
+            temp_frame, frame_context = item
+            # each pipeline thread owns one shared memory slot and keeps one frame in a worker process
+            thread_id = threading.get_ident()
+            if thread_id not in shared_memories or shared_memories[thread_id].size < temp_frame.nbytes:
+                if thread_id in shared_memories:
+                    shared_memories[thread_id].close()
+                    shared_memories[thread_id].unlink()
+                shared_memories[thread_id] = shared_memory.SharedMemory(create=True, size=temp_frame.nbytes)
+            shared_frame = numpy.ndarray(temp_frame.shape, dtype=numpy.uint8, buffer=shared_memories[thread_id].buf)
+            shared_frame[:] = temp_frame
+            result = process_pool.submit(process_shared_frame, shared_memories[thread_id].name, temp_frame.shape, source_path, frame_context['faces']).result()
+            if result is None:
+                result = shared_frame.copy()
+            del shared_frame
+            return result
+
+        try:
+            run_frame_pipeline(frames, process_frame, write_frame, execution_threads)
+        finally:
+            for shared_memory_slot in shared_memories.values():
+                shared_memory_slot.close()
+                shared_memory_slot.unlink()
+
+
+def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None, checkpoint_names: Optional[List[str]] = None) -> None:
+
+    # frames go to the frame processors in chunks so detection can run on a batch
+    detection_batch_size = max(modules.globals.detection_batch_size, 1)
+    temp_frame_path_batches = [temp_frame_paths[index:index + detection_batch_size] for index in range(0, len(temp_frame_paths), detection_batch_size)]
+
+    checkpointed = modules.globals.resume and bool(checkpoint_names)
+    stage_name = '+'.join(checkpoint_names or [])
+
+    def stage_frames(temp_frame_path_batch: List[str]) -> List[str]:
+        if checkpointed:
+            return [stage_temp_frame(temp_frame_path, stage_name) for temp_frame_path in temp_frame_path_batch]
+        return temp_frame_path_batch
+
+    def write_frame(temp_frame_path_batch: List[str]) -> None:
+        if not checkpointed:
+            return
+        for temp_frame_path in temp_frame_path_batch:
+            sync_path(get_staged_frame_path(temp_frame_path, stage_name))
+            for checkpoint_name in checkpoint_names:
+                write_checkpoint(modules.globals.target_path, {'frame_processor': checkpoint_name, 'frame': os.path.basename(temp_frame_path)})
+            commit_temp_frame(temp_frame_path, stage_name)
+
+    if modules.globals.execution_backend == 'process':
+        face_maps, face_store_state, face_store_memories = share_face_maps() if modules.globals.map_faces else (None, None, [])
+        try:
+            with create_process_pool(face_maps=face_maps, face_store_state=face_store_state) as process_pool:
+
+                def process_frame(temp_frame_path_batch: List[str]) -> List[str]:
+                    process_pool.submit(process_frames, source_path, stage_frames(temp_frame_path_batch)).result()
+                    if progress:
+                        progress.update(len(temp_frame_path_batch))
+                    return temp_frame_path_batch
+
+                run_frame_pipeline(temp_frame_path_batches, process_frame, write_frame)
+        finally:
+            for face_store_memory in face_store_memories:
+                face_store_memory.close()
+                face_store_memory.unlink()
+    else:
+
+        def process_frame(temp_frame_path_batch: List[str]) -> List[str]:
+            process_frames(source_path, stage_frames(temp_frame_path_batch), progress)
+            return temp_frame_path_batch
+
+        run_frame_pipeline(temp_frame_path_batches, process_frame, write_frame)
+
+
+def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None], checkpoint_names: Optional[List[str]] = None) -> None:
+    if modules.globals.resume and checkpoint_names:
+        pending_frame_paths = get_pending_frame_paths(modules.globals.target_path, checkpoint_names, frame_paths)
+        # recorded frames interrupted before their commit are committed now
+        for temp_frame_path in set(frame_paths).difference(pending_frame_paths):
+            commit_temp_frame(temp_frame_path, '+'.join(checkpoint_names))
+        frame_paths = pending_frame_paths
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(frame_paths)
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
-        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
-        multi_process_frame(source_path, frame_paths, process_frames, progress)
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_backend': modules.globals.execution_backend, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+        multi_process_frame(source_path, frame_paths, process_frames, progress, checkpoint_names)
+
+
+def process_fused_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    source_face = get_source_face(source_path)
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    for temp_frame_path, temp_frame, frame_context in zip(temp_frame_paths, temp_frames, create_frame_contexts(temp_frames)):
+        result = process_frame_chain(frame_processors, source_face, temp_frame, temp_frame_path, frame_context)
+        write_temp_frame(temp_frame_path, result)
+        if progress:
+            progress.update(1)
+
+
+def process_video_fused(source_path: str, frame_paths: List[str]) -> None:
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    process_video(source_path, frame_paths, process_fused_frames, [frame_processor.NAME for frame_processor in frame_processors])
+
+
+def read_frame_contexts(frames: Iterable[Frame]) -> Iterator[Tuple[Frame, Dict[str, Any]]]:
+    # tracking needs the frames in order so it runs on the decode thread before the frames fan out
+    face_tracker = create_face_tracker() if use_face_tracker() and not modules.globals.map_faces else None
+    for temp_frame in frames:
+        if face_tracker is None:
+            yield temp_frame, create_frame_context()
+        else:
+            yield temp_frame, create_frame_context(track_faces(face_tracker, temp_frame, ['landmark_2d_106']))
+
+
+def render_video_stream(source_path: str, frame_reader: Any, frame_writer: Any, resolution: Tuple[int, int], progress: Any, execution_threads: Optional[int] = None) -> bool:
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+
+    def write_temp_frame(temp_frame: Frame) -> None:
+        write_frame(frame_writer, temp_frame)
+        progress.update(1)
+
+    done = False
+    try:
+        if modules.globals.execution_backend == 'process':
+            run_frame_pipeline_in_pool(read_frame_contexts(read_frames(frame_reader, resolution)), source_path, write_temp_frame, execution_threads)
+        else:
+            source_face = get_source_face(source_path)
+            run_frame_pipeline(read_frame_contexts(read_frames(frame_reader, resolution)), lambda item: process_frame_chain(frame_processors, source_face, item[0], frame_context=item[1]), write_temp_frame, execution_threads)
+        done = True
+    except OSError as exception:
+        # an encoder that exited early shows up as a broken pipe
+        print(exception)
+    finally:
+        close_frame_reader(frame_reader)
+        done = close_frame_writer(frame_writer) and done
+    return done
+
+
+def process_video_stream(source_path: str, target_path: str, output_path: str, fps: float) -> bool:
+    resolution = detect_resolution(target_path)
+    audio_path = target_path if modules.globals.keep_audio else None
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    total = get_video_frame_total(target_path)
+    with tqdm(total=total, desc='Streaming', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_backend': modules.globals.execution_backend, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+        return render_video_stream(source_path, open_frame_reader(target_path), open_frame_writer(output_path, fps, resolution, audio_path), resolution, progress)
+
+
+def process_video_segments(source_path: str, target_path: str, output_path: str, fps: float) -> bool:
+    resolution = detect_resolution(target_path)
+    keyframes, frame_total = detect_keyframes(target_path)
+    segments = split_segments(keyframes, frame_total, modules.globals.render_segments)
+    # split the execution threads between the segments rendered concurrently
+    execution_threads = max((modules.globals.execution_threads or 1) // len(segments), 1)
+    create_temp(target_path)
+    temp_directory_path = get_temp_directory_path(target_path)
+    _, output_extension = os.path.splitext(output_path)
+    segment_paths = [os.path.join(temp_directory_path, f'segment_{segment_number:04d}{output_extension}') for segment_number in range(len(segments))]
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    with tqdm(total=frame_total, desc='Rendering', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_backend': modules.globals.execution_backend, 'segments': len(segments), 'execution_threads': execution_threads})
+
+        def render_segment(segment_path: str, segment: Tuple[float, int]) -> bool:
+            start_time, segment_frame_total = segment
+            checkpoint_entry = {'segment': os.path.basename(segment_path), 'settings': get_checkpoint_settings(), 'start_time': start_time, 'frame_total': segment_frame_total}
+            if modules.globals.resume and checkpoint_entry in checkpoint_entries and os.path.isfile(segment_path):
+                progress.update(segment_frame_total)
+                return True
+            if render_video_stream(source_path, open_frame_reader(target_path, start_time, segment_frame_total), open_frame_writer(segment_path, fps, resolution), resolution, progress, execution_threads):
+                write_checkpoint(target_path, checkpoint_entry)
+                return True
+            return False
+
+        checkpoint_entries = load_checkpoint(target_path)
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            rendered = all(executor.map(render_segment, segment_paths, segments))
+    audio_path = target_path if modules.globals.keep_audio else None
+    done = rendered and concat_segments(segment_paths, output_path, audio_path)
+    if done or not modules.globals.resume:
+        clean_temp(target_path)
+    return done
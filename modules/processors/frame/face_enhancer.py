@@ -1,18 +1,24 @@
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 import cv2
 import threading
 import gfpgan
+import numpy as np
 import os
+import torch
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
 
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face
+from modules.face_analyser import get_many_faces, create_frame_contexts
 from modules.typing import Frame, Face
 from modules.utilities import (
     conditional_download,
     is_image,
     is_video,
+    read_temp_frame,
+    write_temp_frame,
 )
 
 FACE_ENHANCER = None
@@ -53,26 +59,51 @@ def get_face_enhancer() -> Any:
     return FACE_ENHANCER
 
 
-def enhance_face(temp_frame: Frame) -> Frame:
+def enhance_face(temp_frame: Frame, target_faces: List[Face]) -> Frame:
     with THREAD_SEMAPHORE:
-        _, _, temp_frame = get_face_enhancer().enhance(temp_frame, paste_back=True)
+        temp_frame = enhance_target_faces(get_face_enhancer(), temp_frame, target_faces)
     return temp_frame
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
+@torch.no_grad()
+def enhance_target_faces(face_enhancer: Any, temp_frame: Frame, target_faces: List[Face]) -> Frame:
+    # follows GFPGANer.enhance but aligns on the analysed keypoints instead of running its own detector
+    face_helper = face_enhancer.face_helper
+    face_helper.clean_all()
+    face_helper.read_image(temp_frame)
+    scale = face_helper.input_img.shape[0] / temp_frame.shape[0]
+    for target_face in target_faces:
+        landmarks = target_face.kps * scale
+        if np.linalg.norm(landmarks[0] - landmarks[1]) >= 5:
+            face_helper.all_landmarks_5.append(landmarks)
+    if not face_helper.all_landmarks_5:
+        return temp_frame
+    face_helper.align_warp_face()
+    for cropped_face in face_helper.cropped_faces:
+        cropped_face_tensor = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+        normalize(cropped_face_tensor, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+        cropped_face_tensor = cropped_face_tensor.unsqueeze(0).to(face_enhancer.device)
+        output = face_enhancer.gfpgan(cropped_face_tensor, return_rgb=False, weight=0.5)[0]
+        restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
+        face_helper.add_restored_face(restored_face.astype('uint8'))
+    face_helper.get_inverse_affine(None)
+    return face_helper.paste_faces_to_input_image(upsample_img=None)
+
+
+def process_frame(source_face: Face, temp_frame: Frame, frame_context: Optional[Dict[str, Any]] = None) -> Frame:
+    target_faces = get_many_faces(temp_frame, ['detection'], frame_context)
+    if target_faces:
+        temp_frame = enhance_face(temp_frame, target_faces)
     return temp_frame
 
 
 def process_frames(
     source_path: str, temp_frame_paths: List[str], progress: Any = None
 ) -> None:
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(None, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
+    temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    for temp_frame_path, temp_frame, frame_context in zip(temp_frame_paths, temp_frames, create_frame_contexts(temp_frames)):
+        result = process_frame(None, temp_frame, frame_context)
+        write_temp_frame(temp_frame_path, result)
         if progress:
             progress.update(1)
 
@@ -84,11 +115,11 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+    modules.processors.frame.core.process_video(None, temp_frame_paths, process_frames, [NAME])
 
 
-def process_frame_v2(temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
+def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "", frame_context: Optional[Dict[str, Any]] = None) -> Frame:
+    target_faces = get_many_faces(temp_frame, ['detection'], frame_context)
+    if target_faces:
+        temp_frame = enhance_face(temp_frame, target_faces)
     return temp_frame
@@ -1,23 +1,35 @@
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 import cv2
-import insightface
 import threading
 import numpy as np
+import onnxruntime
+from onnx import load as load_onnx, numpy_helper
+from insightface.utils import face_align
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face, get_many_faces, default_source_face
+from modules.face_analyser import get_one_face, get_many_faces, get_source_face, create_frame_context, create_frame_contexts, update_frame_context, default_source_face, get_target_faces_in_frame
 from modules.typing import Face, Frame
 from modules.utilities import (
     conditional_download,
     is_image,
     is_video,
+    read_temp_frame,
+    write_temp_frame,
 )
 from modules.cluster_analysis import find_closest_centroid
 import os
 
 FACE_SWAPPER = None
 THREAD_LOCK = threading.Lock()
+SOURCE_LATENTS: Dict[bytes, np.ndarray] = {}
+SWAPPER_BUFFERS = threading.local()
+SWAPPER_GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
 NAME = "DLC.FACE-SWAPPER"
 
 abs_dir = os.path.dirname(os.path.abspath(__file__))
@@ -38,8 +50,8 @@ def pre_start() -> bool:
     if not modules.globals.map_faces and not is_image(modules.globals.source_path):
         update_status("Select an image for source path.", NAME)
         return False
-    elif not modules.globals.map_faces and not get_one_face(
-        cv2.imread(modules.globals.source_path)
+    elif not modules.globals.map_faces and not get_source_face(
+        modules.globals.source_path
     ):
         update_status("No face in source path detected.", NAME)
         return False
@@ -51,25 +63,111 @@ def pre_start() -> bool:
     return True
 
 
-def get_face_swapper() -> Any:
+def get_face_swapper() -> Dict[str, Any]:
     global FACE_SWAPPER
 
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
             model_path = os.path.join(models_dir, 'inswapper_128_fp16.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(
-                model_path, providers=modules.globals.execution_providers
+            session = onnxruntime.InferenceSession(
+                model_path, sess_options=create_swapper_session_options(), providers=modules.globals.execution_providers
             )
+            inputs = session.get_inputs()
+            output = session.get_outputs()[0]
+            FACE_SWAPPER = {
+                'session': session,
+                # the last initializer maps arcface embeddings into the latent space of the swapper
+                'emap': numpy_helper.to_array(load_onnx(model_path).graph.initializer[-1]).astype(np.float32),
+                'input_names': [input.name for input in inputs],
+                'input_dtype': get_tensor_dtype(inputs[0].type),
+                'latent_dtype': get_tensor_dtype(inputs[1].type),
+                'input_size': inputs[0].shape[2],
+                'output_name': output.name,
+                'output_dtype': get_tensor_dtype(output.type),
+            }
     return FACE_SWAPPER
 
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+def create_swapper_session_options() -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = SWAPPER_GRAPH_OPTIMIZATION_LEVELS[modules.globals.swapper_graph_optimization]
+    if modules.globals.swapper_intra_op_threads:
+        session_options.intra_op_num_threads = modules.globals.swapper_intra_op_threads
+    if modules.globals.swapper_inter_op_threads:
+        session_options.inter_op_num_threads = modules.globals.swapper_inter_op_threads
+    return session_options
+
+
+def get_tensor_dtype(tensor_type: str) -> Any:
+    return np.float16 if tensor_type == 'tensor(float16)' else np.float32
+
+
+def get_source_latent(face_swapper: Dict[str, Any], source_face: Face) -> np.ndarray:
+    normed_embedding = source_face.normed_embedding
+    latent_key = normed_embedding.tobytes()
+    if latent_key not in SOURCE_LATENTS:
+        latent = normed_embedding.reshape((1, -1)) @ face_swapper['emap']
+        SOURCE_LATENTS[latent_key] = np.ascontiguousarray(latent / np.linalg.norm(latent), dtype=face_swapper['latent_dtype'])
+    return SOURCE_LATENTS[latent_key]
+
+
+def get_swapper_buffers(face_swapper: Dict[str, Any]) -> Any:
+    # every thread binds its own blob and output once and reuses them for each face it swaps
+    if getattr(SWAPPER_BUFFERS, 'face_swapper', None) is not face_swapper:
+        size = face_swapper['input_size']
+        SWAPPER_BUFFERS.face_swapper = face_swapper
+        SWAPPER_BUFFERS.blob = np.empty((1, 3, size, size), dtype=face_swapper['input_dtype'])
+        SWAPPER_BUFFERS.output = np.empty((1, 3, size, size), dtype=face_swapper['output_dtype'])
+        SWAPPER_BUFFERS.io_binding = face_swapper['session'].io_binding()
+        SWAPPER_BUFFERS.io_binding.bind_input(
+            face_swapper['input_names'][0], 'cpu', 0, SWAPPER_BUFFERS.blob.dtype, SWAPPER_BUFFERS.blob.shape, SWAPPER_BUFFERS.blob.ctypes.data
+        )
+        SWAPPER_BUFFERS.io_binding.bind_output(
+            face_swapper['output_name'], 'cpu', 0, SWAPPER_BUFFERS.output.dtype, SWAPPER_BUFFERS.output.shape, SWAPPER_BUFFERS.output.ctypes.data
+        )
+    return SWAPPER_BUFFERS
+
+
+def run_face_swapper(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
     face_swapper = get_face_swapper()
+    buffers = get_swapper_buffers(face_swapper)
+    latent = get_source_latent(face_swapper, source_face)
+    crop_frame, affine_matrix = face_align.norm_crop2(temp_frame, target_face.kps, face_swapper['input_size'])
+    # same normalisation as the insightface swapper: rgb, planar, scaled to [0, 1]
+    np.multiply(crop_frame[:, :, ::-1].transpose(2, 0, 1), 1 / 255, out=buffers.blob[0], casting='unsafe')
+    buffers.io_binding.bind_input(face_swapper['input_names'][1], 'cpu', 0, latent.dtype, latent.shape, latent.ctypes.data)
+    face_swapper['session'].run_with_iobinding(buffers.io_binding)
+    swapped_crop = np.clip(buffers.output[0].transpose(1, 2, 0) * 255, 0, 255).astype(np.uint8)[:, :, ::-1]
+    return paste_back(temp_frame, swapped_crop, affine_matrix)
+
+
+def paste_back(temp_frame: Frame, swapped_crop: Frame, affine_matrix: np.ndarray) -> Frame:
+    frame_size = (temp_frame.shape[1], temp_frame.shape[0])
+    inverse_matrix = cv2.invertAffineTransform(affine_matrix)
+    swapped_frame = cv2.warpAffine(swapped_crop, inverse_matrix, frame_size, borderValue=0.0)
+    crop_mask = np.full(swapped_crop.shape[:2], 255, dtype=np.float32)
+    frame_mask = cv2.warpAffine(crop_mask, inverse_matrix, frame_size, borderValue=0.0)
+    frame_mask[frame_mask > 20] = 255
+    mask_y, mask_x = np.where(frame_mask == 255)
+    mask_size = int(np.sqrt((np.max(mask_y) - np.min(mask_y)) * (np.max(mask_x) - np.min(mask_x))))
+    erode_size = max(mask_size // 10, 10)
+    frame_mask = cv2.erode(frame_mask, np.ones((erode_size, erode_size), np.uint8), iterations=1)
+    blur_size = max(mask_size // 20, 5) * 2 + 1
+    frame_mask = cv2.GaussianBlur(frame_mask, (blur_size, blur_size), 0)
+    frame_mask = (frame_mask / 255)[:, :, np.newaxis]
+    return (frame_mask * swapped_frame + (1 - frame_mask) * temp_frame.astype(np.float32)).astype(np.uint8)
+
+
+def get_target_face_analyser_modules() -> List[str]:
+    # the swap itself only needs the detector keypoints, the mouth mask adds the 106 landmarks
+    if modules.globals.mouth_mask:
+        return ['detection', 'landmark_2d_106']
+    return ['detection']
+
 
+def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
     # Apply the face swap
-    swapped_frame = face_swapper.get(
-        temp_frame, target_face, source_face, paste_back=True
-    )
+    swapped_frame = run_face_swapper(source_face, target_face, temp_frame)
 
     if modules.globals.mouth_mask:
         # Create a mask for the target face
@@ -94,23 +192,25 @@ def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
     return swapped_frame
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+def process_frame(source_face: Face, temp_frame: Frame, frame_context: Optional[Dict[str, Any]] = None) -> Frame:
     if modules.globals.color_correction:
         temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
 
     if modules.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
+        many_faces = get_many_faces(temp_frame, get_target_face_analyser_modules(), frame_context)
         if many_faces:
             for target_face in many_faces:
                 temp_frame = swap_face(source_face, target_face, temp_frame)
+            update_frame_context(frame_context, many_faces)
     else:
-        target_face = get_one_face(temp_frame)
+        target_face = get_one_face(temp_frame, get_target_face_analyser_modules(), frame_context)
         if target_face:
             temp_frame = swap_face(source_face, target_face, temp_frame)
+            update_frame_context(frame_context, [target_face])
     return temp_frame
 
 
-def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
+def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "", frame_context: Optional[Dict[str, Any]] = None) -> Frame:
     if is_image(modules.globals.target_path):
         if modules.globals.many_faces:
             source_face = default_source_face()
@@ -126,35 +226,25 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                     temp_frame = swap_face(source_face, target_face, temp_frame)
 
     elif is_video(modules.globals.target_path):
+        # faces assigned on demand are analysed once, before the first swap changes the frame
+        if frame_context is None:
+            frame_context = create_frame_context()
         if modules.globals.many_faces:
             source_face = default_source_face()
             for map in modules.globals.souce_target_map:
-                target_frame = [
-                    f
-                    for f in map["target_faces_in_frame"]
-                    if f["location"] == temp_frame_path
-                ]
-
-                for frame in target_frame:
-                    for target_face in frame["faces"]:
-                        temp_frame = swap_face(source_face, target_face, temp_frame)
+                for target_face in get_target_faces_in_frame(map, temp_frame_path, temp_frame, frame_context):
+                    temp_frame = swap_face(source_face, target_face, temp_frame)
 
         elif not modules.globals.many_faces:
             for map in modules.globals.souce_target_map:
                 if "source" in map:
-                    target_frame = [
-                        f
-                        for f in map["target_faces_in_frame"]
-                        if f["location"] == temp_frame_path
-                    ]
                     source_face = map["source"]["face"]
 
-                    for frame in target_frame:
-                        for target_face in frame["faces"]:
-                            temp_frame = swap_face(source_face, target_face, temp_frame)
+                    for target_face in get_target_faces_in_frame(map, temp_frame_path, temp_frame, frame_context):
+                        temp_frame = swap_face(source_face, target_face, temp_frame)
 
     else:
-        detected_faces = get_many_faces(temp_frame)
+        detected_faces = get_many_faces(temp_frame, frame_context=frame_context)
         if modules.globals.many_faces:
             if detected_faces:
                 source_face = default_source_face()
@@ -197,6 +287,8 @@ def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
                             temp_frame,
                         )
                         i += 1
+        if detected_faces:
+            update_frame_context(frame_context, detected_faces)
     return temp_frame
 
 
@@ -204,12 +296,12 @@ def process_frames(
     source_path: str, temp_frame_paths: List[str], progress: Any = None
 ) -> None:
     if not modules.globals.map_faces:
-        source_face = get_one_face(cv2.imread(source_path))
-        for temp_frame_path in temp_frame_paths:
-            temp_frame = cv2.imread(temp_frame_path)
+        source_face = get_source_face(source_path)
+        temp_frames = [read_temp_frame(temp_frame_path) for temp_frame_path in temp_frame_paths]
+        for temp_frame_path, temp_frame, frame_context in zip(temp_frame_paths, temp_frames, create_frame_contexts(temp_frames)):
             try:
-                result = process_frame(source_face, temp_frame)
-                cv2.imwrite(temp_frame_path, result)
+                result = process_frame(source_face, temp_frame, frame_context)
+                write_temp_frame(temp_frame_path, result)
             except Exception as exception:
                 print(exception)
                 pass
@@ -217,10 +309,10 @@ def process_frames(
                 progress.update(1)
     else:
         for temp_frame_path in temp_frame_paths:
-            temp_frame = cv2.imread(temp_frame_path)
+            temp_frame = read_temp_frame(temp_frame_path)
             try:
                 result = process_frame_v2(temp_frame, temp_frame_path)
-                cv2.imwrite(temp_frame_path, result)
+                write_temp_frame(temp_frame_path, result)
             except Exception as exception:
                 print(exception)
                 pass
@@ -230,7 +322,7 @@ def process_frames(
 
 def process_image(source_path: str, target_path: str, output_path: str) -> None:
     if not modules.globals.map_faces:
-        source_face = get_one_face(cv2.imread(source_path))
+        source_face = get_source_face(source_path)
         target_frame = cv2.imread(target_path)
         result = process_frame(source_face, target_frame)
         cv2.imwrite(output_path, result)
@@ -250,7 +342,7 @@ def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
             "Many faces enabled. Using first source image. Progressing...", NAME
         )
     modules.processors.frame.core.process_video(
-        source_path, temp_frame_paths, process_frames
+        source_path, temp_frame_paths, process_frames, [NAME]
     )
 
 
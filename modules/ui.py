@@ -12,11 +12,16 @@ import modules.globals
 import modules.metadata
 from modules.face_analyser import (
     get_one_face,
+    get_source_face,
     get_unique_faces_from_target_image,
     get_unique_faces_from_target_video,
     add_blank_map,
     has_valid_map,
     simplify_maps,
+    create_frame_context,
+    create_face_tracker,
+    use_face_tracker,
+    track_faces,
 )
 from modules.capturer import get_video_frame, get_video_frame_total
 from modules.processors.frame.core import get_frame_processors_modules
@@ -32,6 +37,8 @@ POPUP = None
 POPUP_LIVE = None
 ROOT_HEIGHT = 700
 ROOT_WIDTH = 600
+# full detection every nth camera frame when face tracking is switched on
+FACE_TRACKING_INTERVAL = 5
 
 PREVIEW = None
 PREVIEW_MAX_HEIGHT = 700
@@ -96,7 +103,9 @@ def save_switch_states():
         "fp_ui": modules.globals.fp_ui,
         "show_fps": modules.globals.show_fps,
         "mouth_mask": modules.globals.mouth_mask,
-        "show_mouth_mask_box": modules.globals.show_mouth_mask_box
+        "show_mouth_mask_box": modules.globals.show_mouth_mask_box,
+        "detection_interval": modules.globals.detection_interval,
+        "roi_detection": modules.globals.roi_detection
     }
     with open("switch_states.json", "w") as f:
         json.dump(switch_states, f)
@@ -119,6 +128,8 @@ def load_switch_states():
         modules.globals.show_fps = switch_states.get("show_fps", False)
         modules.globals.mouth_mask = switch_states.get("mouth_mask", False)
         modules.globals.show_mouth_mask_box = switch_states.get("show_mouth_mask_box", False)
+        modules.globals.detection_interval = switch_states.get("detection_interval", modules.globals.detection_interval)
+        modules.globals.roi_detection = switch_states.get("roi_detection", modules.globals.roi_detection)
     except FileNotFoundError:
         # If the file doesn't exist, use default values
         pass
@@ -295,6 +306,19 @@ def create_root(start: Callable[[], None], destroy: Callable[[], None]) -> ctk.C
     )
     show_mouth_mask_box_switch.place(relx=0.6, rely=0.55)
 
+    face_tracking_value = ctk.BooleanVar(value=use_face_tracker())
+    face_tracking_switch = ctk.CTkSwitch(
+        root,
+        text="Track Faces",
+        variable=face_tracking_value,
+        cursor="hand2",
+        command=lambda: (
+            update_face_tracking(face_tracking_value.get()),
+            save_switch_states(),
+        ),
+    )
+    face_tracking_switch.place(relx=0.1, rely=0.5)
+
     start_button = ctk.CTkButton(
         root, text="Start", cursor="hand2", command=lambda: analyze_target(start, root)
     )
@@ -537,6 +561,11 @@ def update_pop_live_status(text: str) -> None:
     popup_status_label_live.configure(text=text)
 
 
+def update_face_tracking(value: bool) -> None:
+    modules.globals.detection_interval = FACE_TRACKING_INTERVAL if value else 1
+    modules.globals.roi_detection = value
+
+
 def update_tumbler(var: str, value: bool) -> None:
     modules.globals.fp_ui[var] = value
     save_switch_states()
@@ -726,11 +755,12 @@ def update_preview(frame_number: int = 0) -> None:
         temp_frame = get_video_frame(modules.globals.target_path, frame_number)
         if modules.globals.nsfw_filter and check_and_ignore_nsfw(temp_frame):
             return
+        frame_context = create_frame_context()
         for frame_processor in get_frame_processors_modules(
             modules.globals.frame_processors
         ):
             temp_frame = frame_processor.process_frame(
-                get_one_face(cv2.imread(modules.globals.source_path)), temp_frame
+                get_source_face(modules.globals.source_path), temp_frame, frame_context=frame_context
             )
         image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
         image = ImageOps.contain(
@@ -789,6 +819,9 @@ def create_webcam_preview(camera_index: int):
     frame_count = 0
     fps = 0
 
+    # consecutive camera frames let the face tracker skip most detections
+    face_tracker = None
+
     while camera:
         ret, frame = camera.read()
         if not ret:
@@ -804,25 +837,33 @@ def create_webcam_preview(camera_index: int):
                 temp_frame, PREVIEW.winfo_width(), PREVIEW.winfo_height()
             )
 
+        if not use_face_tracker():
+            face_tracker = None
+            frame_context = create_frame_context()
+        else:
+            if face_tracker is None:
+                face_tracker = create_face_tracker()
+            frame_context = create_frame_context(track_faces(face_tracker, temp_frame, ["landmark_2d_106"]))
+
         if not modules.globals.map_faces:
             if source_image is None and modules.globals.source_path:
-                source_image = get_one_face(cv2.imread(modules.globals.source_path))
+                source_image = get_source_face(modules.globals.source_path)
 
             for frame_processor in frame_processors:
                 if frame_processor.NAME == "DLC.FACE-ENHANCER":
                     if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame(None, temp_frame)
+                        temp_frame = frame_processor.process_frame(None, temp_frame, frame_context=frame_context)
                 else:
-                    temp_frame = frame_processor.process_frame(source_image, temp_frame)
+                    temp_frame = frame_processor.process_frame(source_image, temp_frame, frame_context=frame_context)
         else:
             modules.globals.target_path = None
 
             for frame_processor in frame_processors:
                 if frame_processor.NAME == "DLC.FACE-ENHANCER":
                     if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame_v2(temp_frame)
+                        temp_frame = frame_processor.process_frame_v2(temp_frame, frame_context=frame_context)
                 else:
-                    temp_frame = frame_processor.process_frame_v2(temp_frame)
+                    temp_frame = frame_processor.process_frame_v2(temp_frame, frame_context=frame_context)
 
         # Calculate and display FPS
         current_time = time.time()
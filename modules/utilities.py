@@ -1,19 +1,35 @@
 import glob
+import hashlib
+import json
 import mimetypes
 import os
 import platform
 import shutil
 import ssl
 import subprocess
+import threading
 import urllib
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Dict, Iterator, Optional, Tuple
 from tqdm import tqdm
+import cv2
+import numpy
 
 import modules.globals
+from modules.typing import Frame
 
-TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
+TEMP_FRAME_FORMATS = ['png', 'bmp', 'jpg', 'npy']
+TEMP_FRAME_JPEG_QUALITY = 95
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+# the options that change the rendered frames, a checkpoint written with others is not resumed
+CHECKPOINT_SETTINGS = ['source_path', 'frame_processors', 'keep_fps', 'temp_frame_format', 'many_faces', 'map_faces', 'color_correction', 'mouth_mask', 'mask_feather_ratio', 'mask_down_size', 'mask_size', 'detection_size', 'min_face_size', 'detection_downscale', 'detection_interval', 'roi_detection', 'analysis_frame_step']
+STAGED_DIRECTORY = 'staged'
+CHECKPOINT_LOCK = threading.Lock()
+PROBE_CACHE: Dict[Tuple[str, float], Dict[str, Any]] = {}
+PACKET_PROBE_CACHE: Dict[Tuple[str, float], Dict[str, Any]] = {}
+PROBE_LOCK = threading.Lock()
+FILE_HASH_CACHE: Dict[Tuple[str, float, int], str] = {}
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
@@ -31,49 +47,395 @@ def run_ffmpeg(args: List[str]) -> bool:
     return False
 
 
-def detect_fps(target_path: str) -> float:
-    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
-    output = subprocess.check_output(command).decode().strip().split('/')
+def open_ffmpeg(args: List[str], **kwargs: Any) -> subprocess.Popen[bytes]:
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', modules.globals.log_level]
+    commands.extend(args)
+    return subprocess.Popen(commands, **kwargs)
+
+
+def parse_frame_rate(frame_rate: str) -> Optional[float]:
     try:
-        numerator, denominator = map(int, output)
+        numerator, denominator = map(int, frame_rate.split('/'))
         return numerator / denominator
     except Exception:
         pass
+    return None
+
+
+def probe_video(target_path: str) -> Dict[str, Any]:
+    probe_key = (os.path.abspath(target_path), os.path.getmtime(target_path))
+    with PROBE_LOCK:
+        if probe_key in PROBE_CACHE:
+            return PROBE_CACHE[probe_key]
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_streams', '-show_format', '-of', 'json', target_path]
+    probe = json.loads(subprocess.check_output(command))
+    stream = (probe.get('streams') or [{}])[0]
+    rotation = int(float(stream.get('tags', {}).get('rotate', 0)))
+    for side_data in stream.get('side_data_list', []):
+        rotation = int(side_data.get('rotation', rotation))
+    width = int(stream.get('width', 0))
+    height = int(stream.get('height', 0))
+    # ffmpeg auto rotates decoded frames
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+    video_probe = {
+        'frame_rate': parse_frame_rate(stream.get('r_frame_rate', '')),
+        'average_frame_rate': parse_frame_rate(stream.get('avg_frame_rate', '')),
+        'frame_total': int(stream.get('nb_frames', 0) or 0),
+        'start_time': float(probe.get('format', {}).get('start_time', 0.0)),
+        'duration': float(probe.get('format', {}).get('duration', 0.0)),
+        'resolution': (width, height),
+        'rotation': rotation,
+        'pix_fmt': stream.get('pix_fmt')
+    }
+    with PROBE_LOCK:
+        PROBE_CACHE[probe_key] = video_probe
+    return video_probe
+
+
+def probe_video_packets(target_path: str) -> Dict[str, Any]:
+    # reading every packet is linear in the file size, so it only runs for the timestamps and keyframes
+    probe_key = (os.path.abspath(target_path), os.path.getmtime(target_path))
+    with PROBE_LOCK:
+        if probe_key in PACKET_PROBE_CACHE:
+            return PACKET_PROBE_CACHE[probe_key]
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'json', target_path]
+    probe = json.loads(subprocess.check_output(command))
+    start_time = probe_video(target_path)['start_time']
+    packets = sorted((float(packet['pts_time']) - start_time, 'K' in packet.get('flags', '')) for packet in probe.get('packets', []) if packet.get('pts_time', 'N/A') != 'N/A')
+    pts = [pts_time for pts_time, _ in packets]
+    frame_durations = numpy.diff(pts)
+    video_packets = {
+        'pts': pts,
+        'keyframes': [(frame_number, pts_time) for frame_number, (pts_time, is_keyframe) in enumerate(packets) if is_keyframe],
+        # frame intervals beyond timestamp rounding mean variable frame rate
+        'variable_frame_rate': bool(frame_durations.size and numpy.ptp(frame_durations) > 0.001)
+    }
+    with PROBE_LOCK:
+        PACKET_PROBE_CACHE[probe_key] = video_packets
+    return video_packets
+
+
+def has_variable_frame_rate(target_path: str) -> bool:
+    video_probe = probe_video(target_path)
+    # the rates only disagree for variable frame rate or badly muxed files, the packets tell which
+    if video_probe['average_frame_rate'] in [None, video_probe['frame_rate']]:
+        return False
+    return probe_video_packets(target_path)['variable_frame_rate']
+
+
+def is_variable_frame_rate(target_path: str) -> bool:
+    return bool(modules.globals.keep_fps and has_variable_frame_rate(target_path))
+
+
+def detect_fps(target_path: str) -> float:
+    try:
+        video_probe = probe_video(target_path)
+        fps = video_probe['frame_rate']
+        if not fps or has_variable_frame_rate(target_path):
+            fps = video_probe['average_frame_rate'] or fps
+        return fps or 30.0
+    except Exception:
+        pass
     return 30.0
 
 
-def extract_frames(target_path: str) -> None:
-    temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
+def detect_frame_total(target_path: str) -> int:
+    # containers without a frame count fall back to counting the packets
+    return probe_video(target_path)['frame_total'] or len(probe_video_packets(target_path)['pts'])
+
+
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    return probe_video(target_path)['resolution']
 
 
-def create_video(target_path: str, fps: float = 30.0) -> None:
-    temp_output_path = get_temp_output_path(target_path)
+def detect_keyframes(target_path: str) -> Tuple[List[Tuple[int, float]], int]:
+    video_packets = probe_video_packets(target_path)
+    return video_packets['keyframes'], len(video_packets['pts'])
+
+
+def split_segments(keyframes: List[Tuple[int, float]], frame_total: int, segment_total: int) -> List[Tuple[float, int]]:
+    start_frames = [(0, 0.0)]
+    for segment_number in range(1, segment_total):
+        if not keyframes:
+            break
+        target_frame = frame_total * segment_number // segment_total
+        start_frame, start_time = min(keyframes, key=lambda keyframe: abs(keyframe[0] - target_frame))
+        if start_frame > start_frames[-1][0]:
+            start_frames.append((start_frame, start_time))
+    end_frames = [start_frame for start_frame, _ in start_frames[1:]] + [frame_total]
+    return [(start_time, end_frame - start_frame) for (start_frame, start_time), end_frame in zip(start_frames, end_frames)]
+
+
+def extract_frames(target_path: str) -> None:
+    temp_directory_path = get_temp_directory_path(target_path)
+    temp_frame_format = modules.globals.temp_frame_format
+    if temp_frame_format == 'npy':
+        frame_reader = open_frame_reader(target_path)
+        for frame_number, frame in enumerate(read_frames(frame_reader, detect_resolution(target_path)), start=1):
+            write_temp_frame(os.path.join(temp_directory_path, f'{frame_number:04d}.npy'), frame)
+        close_frame_reader(frame_reader)
+        return
+    commands = ['-i', target_path]
+    if is_variable_frame_rate(target_path):
+        commands.extend(['-vsync', 'passthrough'])
+    if temp_frame_format == 'png':
+        commands.extend(['-pix_fmt', 'rgb24'])
+        if modules.globals.temp_frame_compression is not None:
+            commands.extend(['-compression_level', str(modules.globals.temp_frame_compression)])
+    if temp_frame_format == 'bmp':
+        commands.extend(['-pix_fmt', 'bgr24'])
+    if temp_frame_format == 'jpg':
+        commands.extend(['-qmin', '1', '-q:v', '2'])
+    commands.append(os.path.join(temp_directory_path, f'%04d.{temp_frame_format}'))
+    run_ffmpeg(commands)
+
+
+def create_video(target_path: str, output_path: str, fps: float = 30.0) -> bool:
+    audio_path = target_path if modules.globals.keep_audio else None
+    done = encode_video(target_path, output_path, fps, audio_path)
+    if not done and audio_path:
+        # the original audio could not be muxed into the output container
+        done = encode_video(target_path, output_path, fps)
+    return done
+
+
+def encode_video(target_path: str, output_path: str, fps: float, audio_path: Optional[str] = None) -> bool:
+    temp_directory_path = get_temp_directory_path(target_path)
+    temp_frame_format = modules.globals.temp_frame_format
+    if temp_frame_format == 'npy':
+        temp_frame_paths = get_temp_frame_paths(target_path)
+        if not temp_frame_paths:
+            return False
+        height, width = read_temp_frame(temp_frame_paths[0]).shape[:2]
+        frame_writer = open_frame_writer(output_path, fps, (width, height), audio_path)
+        try:
+            for temp_frame_path in temp_frame_paths:
+                write_frame(frame_writer, read_temp_frame(temp_frame_path))
+        except OSError:
+            close_frame_writer(frame_writer)
+            return False
+        return close_frame_writer(frame_writer)
+    commands = ['-r', str(fps), '-i', os.path.join(temp_directory_path, f'%04d.{temp_frame_format}')]
+    if is_variable_frame_rate(target_path):
+        # reuse the original frame timestamps instead of forcing a constant rate
+        commands = ['-f', 'concat', '-safe', '0', '-i', create_frame_timestamps(target_path), '-vsync', 'passthrough']
+    if audio_path:
+        commands.extend(['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?'])
+    commands.extend(['-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', output_path])
+    return run_ffmpeg(commands)
+
+
+def create_frame_timestamps(target_path: str) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-r', str(fps), '-i', os.path.join(temp_directory_path, '%04d.png'), '-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', temp_output_path])
+    temp_frame_paths = get_temp_frame_paths(target_path)
+    pts = probe_video_packets(target_path)['pts'][:len(temp_frame_paths)]
+    frame_durations = numpy.diff(pts).tolist()
+    frame_durations.append(float(numpy.median(frame_durations)) if frame_durations else 1 / detect_fps(target_path))
+    frame_timestamps_path = os.path.join(temp_directory_path, 'frames.ffconcat')
+    with open(frame_timestamps_path, 'w') as frame_timestamps:
+        frame_timestamps.write('ffconcat version 1.0\n')
+        for temp_frame_path, frame_duration in zip(temp_frame_paths, frame_durations):
+            frame_timestamps.write(f"file '{os.path.basename(temp_frame_path)}'\nduration {frame_duration:.6f}\n")
+    return frame_timestamps_path
+
+
+def open_frame_reader(target_path: str, start_time: Optional[float] = None, frame_total: Optional[int] = None) -> subprocess.Popen[bytes]:
+    commands = ['-hwaccel', 'auto']
+    if is_variable_frame_rate(target_path):
+        commands.extend(['-vsync', 'passthrough'])
+    if start_time is not None:
+        # seek just before the keyframe so it is not dropped by rounding
+        commands.extend(['-ss', str(max(start_time - 0.001, 0.0))])
+    commands.extend(['-i', target_path])
+    if frame_total is not None:
+        commands.extend(['-frames:v', str(frame_total)])
+    commands.extend(['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'])
+    return open_ffmpeg(commands, stdout=subprocess.PIPE)
+
+
+def open_frame_writer(output_path: str, fps: float, resolution: Tuple[int, int], audio_path: Optional[str] = None) -> subprocess.Popen[bytes]:
+    width, height = resolution
+    commands = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+    if audio_path:
+        commands.extend(['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?'])
+    commands.extend(['-c:v', modules.globals.video_encoder, '-crf', str(modules.globals.video_quality), '-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', output_path])
+    return open_ffmpeg(commands, stdin=subprocess.PIPE)
+
+
+def read_frame(frame_reader: subprocess.Popen[bytes], resolution: Tuple[int, int]) -> Optional[Frame]:
+    width, height = resolution
+    frame = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    if frame_reader.stdout.readinto(frame.data) < frame.nbytes:
+        return None
+    return frame
+
+
+def read_frames(frame_reader: subprocess.Popen[bytes], resolution: Tuple[int, int]) -> Iterator[Frame]:
+    while True:
+        frame = read_frame(frame_reader, resolution)
+        if frame is None:
+            break
+        yield frame
+
+
+def write_frame(frame_writer: subprocess.Popen[bytes], frame: Frame) -> None:
+    frame_writer.stdin.write(numpy.ascontiguousarray(frame).data)
+
+
+def close_frame_reader(frame_reader: subprocess.Popen[bytes]) -> None:
+    frame_reader.stdout.close()
+    frame_reader.wait()
+
+
+def close_frame_writer(frame_writer: subprocess.Popen[bytes]) -> bool:
+    try:
+        frame_writer.stdin.close()
+    except OSError:
+        # the encoder already exited, its exit code tells why
+        pass
+    return frame_writer.wait() == 0
 
 
-def restore_audio(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
-    if not done:
-        move_temp(target_path, output_path)
+def concat_segments(segment_paths: List[str], output_path: str, audio_path: Optional[str] = None) -> bool:
+    concat_list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+    with open(concat_list_path, 'w') as concat_list:
+        for segment_path in segment_paths:
+            concat_list.write(f"file '{os.path.abspath(segment_path)}'\n")
+    commands = ['-f', 'concat', '-safe', '0', '-i', concat_list_path]
+    if audio_path:
+        commands.extend(['-i', audio_path, '-map', '0:v:0', '-map', '1:a:0?'])
+    commands.extend(['-c:v', 'copy', '-y', output_path])
+    return run_ffmpeg(commands)
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    # frame numbers outgrow the zero padding past 9999 frames, so sort them as numbers
+    return sorted(glob.glob((os.path.join(glob.escape(temp_directory_path), f'*.{modules.globals.temp_frame_format}'))), key=get_frame_number)
+
+
+def get_frame_number(temp_frame_path: str) -> int:
+    return int(Path(temp_frame_path).stem)
+
+
+def read_temp_frame(temp_frame_path: str) -> Frame:
+    if temp_frame_path.endswith('.npy'):
+        return numpy.load(temp_frame_path)
+    return cv2.imread(temp_frame_path)
+
+
+def write_temp_frame(temp_frame_path: str, frame: Frame) -> None:
+    if temp_frame_path.endswith('.npy'):
+        numpy.save(temp_frame_path, frame)
+    elif temp_frame_path.endswith('.png') and modules.globals.temp_frame_compression is not None:
+        cv2.imwrite(temp_frame_path, frame, [cv2.IMWRITE_PNG_COMPRESSION, modules.globals.temp_frame_compression])
+    elif temp_frame_path.endswith('.jpg'):
+        cv2.imwrite(temp_frame_path, frame, [cv2.IMWRITE_JPEG_QUALITY, TEMP_FRAME_JPEG_QUALITY])
+    else:
+        cv2.imwrite(temp_frame_path, frame)
 
 
 def get_temp_directory_path(target_path: str) -> str:
     target_name, _ = os.path.splitext(os.path.basename(target_path))
     target_directory_path = os.path.dirname(target_path)
-    return os.path.join(target_directory_path, TEMP_DIRECTORY, target_name)
+    return os.path.join(target_directory_path, TEMP_DIRECTORY, modules.globals.temp_directory_name or target_name)
 
 
-def get_temp_output_path(target_path: str) -> str:
+def get_checkpoint_path(target_path: str) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
-    return os.path.join(temp_directory_path, TEMP_FILE)
+    return os.path.join(temp_directory_path, CHECKPOINT_FILE)
+
+
+def load_checkpoint(target_path: str) -> List[Dict[str, Any]]:
+    checkpoint_path = get_checkpoint_path(target_path)
+    entries = []
+    if os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # skip the torn last line of an interrupted write
+                    pass
+    return entries
+
+
+def write_checkpoint(target_path: str, entry: Dict[str, Any]) -> None:
+    if modules.globals.resume:
+        with CHECKPOINT_LOCK, open(get_checkpoint_path(target_path), 'a') as checkpoint_file:
+            checkpoint_file.write(json.dumps(entry) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+
+def clear_checkpoint(target_path: str) -> None:
+    checkpoint_path = get_checkpoint_path(target_path)
+    if os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def get_checkpoint_settings() -> Dict[str, Any]:
+    # round trip through json so the settings compare equal to the ones loaded from the checkpoint
+    return json.loads(json.dumps({name: getattr(modules.globals, name) for name in CHECKPOINT_SETTINGS}))
+
+
+def has_checkpoint(target_path: str) -> bool:
+    checkpoint_settings = get_checkpoint_settings()
+    return any(entry.get('extracted') and entry.get('settings') == checkpoint_settings for entry in load_checkpoint(target_path))
+
+
+def get_staged_frame_path(temp_frame_path: str, stage_name: str) -> str:
+    # every run of frame processors stages into its own directory so a resume never commits another run's frames
+    return os.path.join(os.path.dirname(temp_frame_path), STAGED_DIRECTORY, stage_name, os.path.basename(temp_frame_path))
+
+
+def stage_temp_frame(temp_frame_path: str, stage_name: str) -> str:
+    # a checkpointed frame is processed on a copy so the original stays untouched until the frame is recorded
+    staged_frame_path = get_staged_frame_path(temp_frame_path, stage_name)
+    os.makedirs(os.path.dirname(staged_frame_path), exist_ok=True)
+    shutil.copyfile(temp_frame_path, staged_frame_path)
+    return staged_frame_path
+
+
+def commit_temp_frame(temp_frame_path: str, stage_name: str) -> None:
+    # a frame is recorded before its commit, so a resume commits the staged frames left behind again
+    staged_frame_path = get_staged_frame_path(temp_frame_path, stage_name)
+    if os.path.isfile(staged_frame_path):
+        os.replace(staged_frame_path, temp_frame_path)
+        sync_path(os.path.dirname(temp_frame_path))
+
+
+def sync_path(path: str) -> None:
+    try:
+        file_descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(file_descriptor)
+        finally:
+            os.close(file_descriptor)
+    except OSError:
+        # directories can only be synced on posix
+        pass
+
+
+def get_pending_frame_paths(target_path: str, frame_processor_names: List[str], temp_frame_paths: List[str]) -> List[str]:
+    done_frames: Dict[str, set[str]] = {frame_processor_name: set() for frame_processor_name in frame_processor_names}
+    for entry in load_checkpoint(target_path):
+        if entry.get('frame_processor') in done_frames:
+            done_frames[entry['frame_processor']].add(entry['frame'])
+    return [temp_frame_path for temp_frame_path in temp_frame_paths if not all(os.path.basename(temp_frame_path) in frames for frames in done_frames.values())]
+
+
+def get_file_hash(file_path: str) -> str:
+    file_stat = os.stat(file_path)
+    hash_key = (os.path.abspath(file_path), file_stat.st_mtime, file_stat.st_size)
+    if hash_key not in FILE_HASH_CACHE:
+        file_hash = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                file_hash.update(chunk)
+        FILE_HASH_CACHE[hash_key] = file_hash.hexdigest()
+    return FILE_HASH_CACHE[hash_key]
 
 
 def normalize_output_path(source_path: str, target_path: str, output_path: str) -> Any:
@@ -90,21 +452,17 @@ def create_temp(target_path: str) -> None:
     Path(temp_directory_path).mkdir(parents=True, exist_ok=True)
 
 
-def move_temp(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
-    if os.path.isfile(temp_output_path):
-        if os.path.isfile(output_path):
-            os.remove(output_path)
-        shutil.move(temp_output_path, output_path)
-
-
 def clean_temp(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
     parent_directory_path = os.path.dirname(temp_directory_path)
     if not modules.globals.keep_frames and os.path.isdir(temp_directory_path):
         shutil.rmtree(temp_directory_path)
     if os.path.exists(parent_directory_path) and not os.listdir(parent_directory_path):
-        os.rmdir(parent_directory_path)
+        try:
+            os.rmdir(parent_directory_path)
+        except OSError:
+            # a concurrent batch job created its temp directory in the meantime
+            pass
 
 
 def has_image_extension(image_path: str) -> bool: